@@ -2,24 +2,560 @@ import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, InputFile
 from telegram.constants import ParseMode
 from telegram.ext import Application, CommandHandler, CallbackContext, CallbackQueryHandler
+from telegram.request import HTTPXRequest
 import telegram
 import sqlite3
 import json
+import os
+import time
 import uuid
 import random
 import asyncio
+import bisect
+import collections
+import heapq
+import io
+import queue
+import threading
+import contextvars
+import functools
+import sys
+import concurrent.futures
+import argparse
+import calendar
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 # Logging configuration
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize database
-def init_db():
-    conn = sqlite3.connect('game.db')
+# Metrics configuration; the Prometheus endpoint is served when METRICS_PORT is set
+METRICS_PORT = int(os.environ['METRICS_PORT']) if os.environ.get('METRICS_PORT') else None
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+EVENT_LOOP_LAG_INTERVAL = 0.5
+ADMIN_IDS = {int(admin_id) for admin_id in os.environ.get('ADMIN_IDS', '').split(',') if admin_id.strip()}
+
+# In-process counters and histograms rendered in the Prometheus text format.
+# Labels are passed as tuples of (name, value) pairs.
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def set(self, name, value, labels=()):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in pairs) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for kind, series in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines += [f"{name}{self._labels(labels)} {value}" for (key, labels), value in sorted(series.items()) if key == name]
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (key, labels), (buckets, counts, total, count) in sorted(self._histograms.items()):
+                    if key != name:
+                        continue
+                    lines += [f"{name}_bucket{self._labels(labels, (('le', bound),))} {bucket_count}"
+                              for bound, bucket_count in zip(buckets, counts)]
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# SQL work done on behalf of one handler invocation
+class RequestStats:
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+# Stats of the handler running in the current task; read by the database layer
+request_stats = contextvars.ContextVar('request_stats', default=None)
+# Stats of the transaction running on the current database worker thread
+_thread_stats = threading.local()
+
+# Function to derive the metric label of a callback query from its data, e.g. 'buy_3_10' -> 'buy',
+# 'show_market_2' -> 'show_market', so labels don't grow with product ids or page numbers
+def callback_label(update):
+    data = update.callback_query.data or ''
+    prefix = data.split('_')[0]
+    if prefix in ('buy', 'sell', 'ranking', 'trades', 'notify'):
+        return prefix
+    screen, _, page = data.rpartition('_')
+    return screen if page.isdigit() else data
+
+# Function to wrap a handler so its latency, errors, SQL statements and SQL time are recorded
+def instrumented(name, callback, label=None):
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        handler_label = f"{name}:{label(update)}" if label else name
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context, *args, **kwargs)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', (('handler', handler_label),))
+            raise
+        finally:
+            request_stats.reset(token)
+            labels = (('handler', handler_label),)
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started, labels)
+            metrics.observe('bot_handler_sql_statements', stats.statements, labels, COUNT_BUCKETS)
+            metrics.observe('bot_handler_sql_seconds', stats.sql_seconds, labels)
+    return wrapper
+
+# Bot API transport that records every call's latency and failures per API method
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        labels = (('method', api_method),)
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.inc('bot_telegram_api_errors_total', labels + (('error', type(e).__name__),))
+            raise
+        finally:
+            metrics.observe('bot_telegram_api_seconds', time.perf_counter() - started, labels)
+        metrics.inc('bot_telegram_api_calls_total', labels)
+        if status >= 400:
+            metrics.inc('bot_telegram_api_errors_total', labels + (('error', str(status)),))
+        return status, payload
+
+# Function to measure how late the event loop wakes up, i.e. how long callbacks block it
+async def monitor_event_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - EVENT_LOOP_LAG_INTERVAL)
+        metrics.observe('bot_event_loop_lag_seconds', lag)
+        metrics.set('bot_event_loop_lag_last_seconds', lag)
+
+# Function to serve the metrics in the Prometheus text format over plain HTTP
+async def serve_metrics(port=METRICS_PORT):
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            if request_line.split(b' ')[1:2] == [b'/metrics']:
+                body, status = metrics.render().encode(), b'200 OK'
+            else:
+                body, status = b'not found\n', b'404 Not Found'
+            writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         + f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, '0.0.0.0', port)
+
+# Sampling profiler: records the stacks of every thread at a fixed interval and writes them
+# in the folded format read by flamegraph.pl and speedscope ("frame;frame;frame count").
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+
+    def _sample(self, own_thread):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    # Samples for the given number of seconds; blocking, so run it on a separate thread
+    def run(self, seconds):
+        own_thread = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            self._sample(own_thread)
+            time.sleep(self.interval)
+        return self.folded()
+
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+PROFILE_MAX_SECONDS = 300
+
+# Function to handle the admin /profile <seconds> command, replying with a flamegraph-compatible profile
+async def profile(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        seconds = min(float(context.args[0]) if context.args else 10.0, PROFILE_MAX_SECONDS)
+    except ValueError:
+        await update.message.reply_text("Usage: /profile <seconds>")
+        return
+
+    await update.message.reply_text(f"Profiling for {seconds:.0f} seconds...")
+    folded = await asyncio.get_running_loop().run_in_executor(None, SamplingProfiler().run, seconds)
+    filename = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+    await context.bot.send_document(chat_id=update.effective_chat.id, document=InputFile(folded.encode(), filename=filename),
+                                    caption="Folded stacks, open with speedscope or flamegraph.pl")
+
+# Database configuration
+DB_PATH = os.environ.get('GAME_DB', 'game.db')
+# Bump whenever init_db() changes the schema, so existing databases are migrated on the next start
+SCHEMA_VERSION = 19
+DB_POOL_SIZE = 4
+DB_BUSY_TIMEOUT = 5.0  # Seconds a connection waits for a lock held by another writer
+DB_PRAGMAS = [
+    "PRAGMA synchronous = NORMAL",  # Safe with WAL, avoids an fsync on every commit
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",  # 16 MB page cache per connection
+    "PRAGMA mmap_size = 134217728",
+]
+# Multi-worker mode (WORKER_COUNT > 1): user-scoped tables (users, holdings, transactions, outbox)
+# are sharded over one SQLite file per worker, and the market, price history, companies, referrals
+# and the user directory live in a shared file attached to every connection as "shared"
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', '1'))
+WORKER_INDEX = int(os.environ.get('WORKER_INDEX', '0'))
+SHARDED = WORKER_COUNT > 1
+SHARED_DB_PATH = os.environ.get('SHARED_DB', 'shared.db')
+SHARED = 'shared' if SHARDED else 'main'  # Schema holding the shared tables
+SHARED_DB_PRAGMAS = [
+    "PRAGMA shared.synchronous = NORMAL",
+    "PRAGMA shared.cache_size = -16000",
+]
+MARKET_SYNC_INTERVAL = 1.0  # Seconds between picking up market changes made by other workers
+LEADERBOARD_SYNC_INTERVAL = 30.0  # Seconds between reloading the ranking from all shards
+
+# Function to return the shard owning a user; a multiplicative hash spreads sequential ids evenly
+# and its high bits are mapped onto the shard range
+def shard_of(user_id, count=WORKER_COUNT):
+    return (int(user_id) * 2654435761 % 2 ** 32) * count >> 32
+
+# Function to return the database file of a shard, e.g. game.db -> game.2.db
+def shard_path(shard):
+    if not SHARDED:
+        return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}.{shard}{ext}"
+
+# Callbacks registered with after_commit() by the transaction running on the current database worker thread
+_commit_hooks = threading.local()
+
+# Function to update in-memory state (leaderboard, market snapshot) once the current transaction commits.
+# Called from transaction functions; the callbacks are dropped if the transaction rolls back. Outside a
+# transaction run by Database, e.g. in init_db(), fn(*args) runs right away.
+def after_commit(fn, *args):
+    hooks = getattr(_commit_hooks, 'pending', None)
+    if hooks is None:
+        fn(*args)
+    else:
+        hooks.append((fn, args))
+
+# Group commit: writes submitted within this window, or up to this many, share one commit
+GROUP_COMMIT_WINDOW = 0.002
+GROUP_COMMIT_MAX_BATCH = 256
+
+# Shared async data-access layer.
+# Keeps a pool of long-lived SQLite connections and runs every query on a worker thread,
+# so handlers never block the event loop while SQLite works.
+class Database:
+    def __init__(self, path=DB_PATH, pool_size=DB_POOL_SIZE, shared_path=None):
+        self.path = path
+        self.pool_size = pool_size
+        self.shared_path = shared_path
+        self._pool = queue.Queue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='db')
+        self._journal = queue.Queue()
+        self._journal_thread = None
+        self._commit_lock = threading.Lock()
+        self._hooks = collections.deque()
+        self._hooks_lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        if self.shared_path:
+            conn.execute("ATTACH DATABASE ? AS shared", (self.shared_path,))
+            for pragma in SHARED_DB_PRAGMAS:
+                conn.execute(pragma)
+        conn.set_trace_callback(self._trace)
+        return conn
+
+    # Counts every executed statement for the transaction running on this thread
+    @staticmethod
+    def _trace(statement):
+        stats = getattr(_thread_stats, 'current', None)
+        if stats is not None:
+            stats.statements += 1
+
+    # Connections are opened lazily, up to pool_size, and reused afterwards
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.pool_size:
+                self._opened += 1
+                return self.connect()
+        return self._pool.get()
+
+    def _release(self, conn):
+        self._pool.put(conn)
+
+    # Commits, then runs the after_commit() callbacks. Callbacks are queued in commit order and run
+    # in that order, so in-memory state never goes back to an older committed value; other writers
+    # can commit while they run. They have all run by the time this returns.
+    def _commit(self, conn, hooks):
+        if not hooks:
+            conn.commit()
+            return
+        with self._commit_lock:
+            conn.commit()
+            self._hooks.extend(hooks)
+        with self._hooks_lock:
+            while self._hooks:
+                fn, args = self._hooks.popleft()
+                try:
+                    fn(*args)
+                except Exception:
+                    logger.exception("After-commit callback %s failed", getattr(fn, '__qualname__', fn))
+
+    # Runs fn(cursor, *args) in one transaction on a pooled connection (worker thread side).
+    # The transaction is opened explicitly by the begin statements, so the reads before the first
+    # write are part of it too: BEGIN IMMEDIATE takes the write lock up front for read-check-write
+    # functions, a plain BEGIN gives read-only functions one consistent snapshot without blocking
+    # writers. Single statements (begin=()) are consistent on their own and skip it.
+    def _transaction(self, stats, begin, fn, *args):
+        conn = self._acquire()
+        _thread_stats.current = stats
+        _commit_hooks.pending = hooks = []
+        started = time.perf_counter()
+        try:
+            c = conn.cursor()
+            for statement in begin:
+                c.execute(statement)
+            result = fn(c, *args)
+            self._commit(conn, hooks)
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _thread_stats.current = None
+            _commit_hooks.pending = None
+            self._release(conn)
+            if stats is not None:
+                stats.sql_seconds += elapsed
+            metrics.observe('bot_db_transaction_seconds', elapsed)
+
+    async def transaction(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._transaction, request_stats.get(), ("BEGIN IMMEDIATE",), fn, *args)
+
+    # Like transaction(), for functions that write only this worker's own tables. BEGIN IMMEDIATE
+    # write-locks every attached file, the shared one included, so in multi-worker mode these start
+    # deferred and take just the shard's write lock with a write that matches no rows; they never
+    # wait for, or hold up, other workers' writes to the shared file.
+    async def local_transaction(self, fn, *args):
+        begin = ("BEGIN", "UPDATE main.users SET id = id WHERE 0") if self.shared_path else ("BEGIN IMMEDIATE",)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._transaction, request_stats.get(), begin, fn, *args)
+
+    # Like transaction(), for functions that only read
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._transaction, request_stats.get(), ("BEGIN",), fn, *args)
+
+    # Like transaction(), but fn(cursor, *args) shares one commit with the writes submitted around it.
+    # Each write runs in its own savepoint, so a failing write is rolled back alone, and the call
+    # returns only after the shared commit, i.e. once the write is durable.
+    async def group_commit(self, fn, *args):
+        with self._lock:
+            if self._journal_thread is None:
+                self._journal_thread = threading.Thread(target=self._journal_writer, name='db_journal', daemon=True)
+                self._journal_thread.start()
+        future = concurrent.futures.Future()
+        self._journal.put((fn, args, future, request_stats.get()))
+        return await asyncio.wrap_future(future)
+
+    # Single writer thread: collects queued writes for up to GROUP_COMMIT_WINDOW and commits them together
+    def _journal_writer(self):
+        conn = self.connect()
+        # Callers are told their write is durable once the batch commits, so the commit must reach the disk
+        conn.execute("PRAGMA synchronous = FULL")
+        if self.shared_path:
+            conn.execute("PRAGMA shared.synchronous = FULL")
+        stopping = False
+        while not stopping:
+            job = self._journal.get()
+            if job is None:
+                break
+            batch = [job]
+            deadline = time.perf_counter() + GROUP_COMMIT_WINDOW
+            while len(batch) < GROUP_COMMIT_MAX_BATCH:
+                try:
+                    job = self._journal.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._commit_batch(conn, batch)
+        conn.close()
+
+    def _commit_batch(self, conn, batch):
+        # Writes whose caller has already given up are dropped
+        batch = [job for job in batch if job[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.perf_counter()
+        done = []
+        hooks = []
+        c = conn.cursor()
+        try:
+            # Trades update the shared market's availability, so in multi-worker mode a batch holds
+            # the shared file's write lock too, and batches of all workers commit one at a time
+            c.execute("BEGIN IMMEDIATE")
+            for fn, args, future, stats in batch:
+                _thread_stats.current = stats
+                _commit_hooks.pending = job_hooks = []
+                job_started = time.perf_counter()
+                c.execute("SAVEPOINT journal_write")
+                try:
+                    done.append((future, fn(c, *args)))
+                    c.execute("RELEASE journal_write")
+                    hooks += job_hooks
+                except Exception as e:
+                    c.execute("ROLLBACK TO journal_write")
+                    c.execute("RELEASE journal_write")
+                    future.set_exception(e)
+                finally:
+                    _thread_stats.current = None
+                    _commit_hooks.pending = None
+                    if stats is not None:
+                        stats.sql_seconds += time.perf_counter() - job_started
+            self._commit(conn, hooks)
+        except Exception as e:
+            conn.rollback()
+            for future in [job[2] for job in batch]:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            metrics.observe('bot_db_group_commit_seconds', time.perf_counter() - started)
+            metrics.observe('bot_db_group_commit_size', len(batch), buckets=COUNT_BUCKETS + (200, 256))
+        for future, result in done:
+            future.set_result(result)
+
+    async def fetchone(self, sql, params=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._transaction, request_stats.get(), (),
+                                          lambda c: c.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._transaction, request_stats.get(), (),
+                                          lambda c: c.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        return await self.transaction(lambda c: c.execute(sql, params).rowcount)
+
+    # Like execute(), for a statement that writes only this worker's own tables
+    async def execute_local(self, sql, params=()):
+        return await self.local_transaction(lambda c: c.execute(sql, params).rowcount)
+
+    def close(self):
+        if self._journal_thread is not None:
+            self._journal.put(None)
+            self._journal_thread.join()
+            self._journal_thread = None
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._opened = 0
+
+# This worker's shard; handlers only touch the data of users routed to this worker
+db = Database(shard_path(WORKER_INDEX), shared_path=SHARED_DB_PATH if SHARDED else None)
+_shard_databases = {WORKER_INDEX: db}
+
+# Function to return the database of a shard, opening a small pool for other workers' shards on first use
+def shard_database(shard):
+    database = _shard_databases.get(shard)
+    if database is None:
+        database = _shard_databases[shard] = Database(shard_path(shard), pool_size=1, shared_path=SHARED_DB_PATH if SHARDED else None)
+    return database
+
+# Function to return the database holding a user's rows
+def database_for(user_id):
+    return shard_database(shard_of(user_id))
+
+# Function to return the databases of all shards, for the cross-shard aggregation paths
+def all_databases():
+    return [shard_database(shard) for shard in range(WORKER_COUNT)]
+
+def close_databases():
+    for database in _shard_databases.values():
+        database.close()
+
+# Initialize database. Returns immediately when the schema is already at SCHEMA_VERSION.
+# Shared tables are created in the SHARED schema, i.e. the shared file in multi-worker mode.
+def init_db(database=None):
+    conn = (database or db).connect()
     c = conn.cursor()
+    # WAL lets readers run concurrently with a writer; the mode is persistent in the file.
+    # Set before the version check, as a file restored from a snapshot comes back in rollback-journal mode.
+    c.execute("PRAGMA journal_mode = WAL")
+    c.execute(f"PRAGMA {SHARED}.journal_mode = WAL")
+    c.execute("PRAGMA user_version")
+    if c.fetchone()[0] == SCHEMA_VERSION:
+        conn.close()
+        return
     # Add table for companies
-    c.execute('''CREATE TABLE IF NOT EXISTS companies (
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.companies (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     name TEXT,
                     owner_id INTEGER,
@@ -29,7 +565,7 @@ def init_db():
                     FOREIGN KEY (owner_id) REFERENCES users(id)
                 )''')
     # Add table for company members
-    c.execute('''CREATE TABLE IF NOT EXISTS company_members (
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.company_members (
                     company_id INTEGER,
                     user_id INTEGER,
                     role TEXT,
@@ -54,7 +590,7 @@ def init_db():
                     price REAL,
                     date TEXT
                 )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS market (
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.market (
                     id INTEGER PRIMARY KEY,
                     name TEXT,
                     current_price REAL,
@@ -70,9 +606,199 @@ def init_db():
         (6, 'Copper', 4.0, 8000)
     ]
     c.executemany("INSERT OR IGNORE INTO market (id, name, current_price, availability) VALUES (?, ?, ?, ?)", products)
+    # Total stock of a product: what is available plus what all shards' users hold, see reconcile_stock()
+    add_column(c, 'market', 'supply', 'INTEGER')
+
+    # Holdings: one row per (user, product), replaces the JSON users.portfolio column
+    c.execute('''CREATE TABLE IF NOT EXISTS holdings (
+                    user_id INTEGER,
+                    product_id INTEGER,
+                    quantity INTEGER NOT NULL,
+                    FOREIGN KEY (user_id) REFERENCES users(id),
+                    FOREIGN KEY (product_id) REFERENCES market(id),
+                    PRIMARY KEY (user_id, product_id)
+                ) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_holdings_product ON holdings (product_id)")
+    # One-time migration of the old JSON portfolios; migrated rows are reset to '{}'
+    c.execute('''INSERT INTO holdings (user_id, product_id, quantity)
+                 SELECT u.id, CAST(j.key AS INTEGER), j.value FROM users u, json_each(u.portfolio) j
+                 WHERE u.portfolio != '{}' AND j.value > 0
+                 ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity''')
+    c.execute("UPDATE users SET portfolio = '{}' WHERE portfolio != '{}'")
+
+    # Leaderboard: stored wealth per user, kept up to date on every trade and price change
+    if add_column(c, 'users', 'wealth', 'REAL DEFAULT 1000.0'):
+        c.execute(f"UPDATE users SET wealth = {WEALTH_SQL}")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_wealth ON users (wealth DESC)")
+
+    # Broadcasts: users who blocked the bot are skipped, pending messages survive restarts
+    add_column(c, 'users', 'blocked', 'INTEGER DEFAULT 0')
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER,
+                    text TEXT,
+                    reply_markup TEXT,
+                    not_before REAL DEFAULT 0,
+                    attempts INTEGER DEFAULT 0
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_not_before ON outbox (not_before)")
+
+    # Price history: raw ticks plus incrementally maintained OHLC bars per resolution
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.price_ticks (
+                    product_id INTEGER,
+                    ts INTEGER,
+                    price REAL,
+                    PRIMARY KEY (product_id, ts)
+                ) WITHOUT ROWID''')
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.price_ohlc (
+                    product_id INTEGER,
+                    resolution INTEGER,
+                    bucket INTEGER,
+                    open REAL,
+                    high REAL,
+                    low REAL,
+                    close REAL,
+                    PRIMARY KEY (product_id, resolution, bucket)
+                ) WITHOUT ROWID''')
+    # Trade history: per-user keyset pagination and a catalog of monthly archive tables
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS transaction_archives (
+                    name TEXT PRIMARY KEY,
+                    month TEXT
+                )''')
+
+    # Usernames are unique; generated names are handed out from a per-base counter
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.username_counters (
+                    base TEXT PRIMARY KEY,
+                    next INTEGER
+                ) WITHOUT ROWID''')
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_users_username'")
+    if not c.fetchone():
+        migrate_usernames(c)
+        c.execute("CREATE UNIQUE INDEX idx_users_username ON users (username)")
+
+    # Referrals: indexed invite codes, direct referral edges and a closure table of all ancestor/descendant pairs
+    if add_column(c, 'users', 'invite_code', 'TEXT'):
+        c.execute("UPDATE users SET invite_code = substr(invite_link, instr(invite_link, 'start=') + 6) WHERE invite_link LIKE '%start=%'")
+        c.execute("UPDATE users SET invite_code = NULL WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY invite_code)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_invite_code ON users (invite_code)")
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.referrals (
+                    invitee_id INTEGER PRIMARY KEY,
+                    inviter_id INTEGER,
+                    created_at TEXT,
+                    FOREIGN KEY (inviter_id) REFERENCES users(id),
+                    FOREIGN KEY (invitee_id) REFERENCES users(id)
+                )''')
+    c.execute(f"CREATE INDEX IF NOT EXISTS {SHARED}.idx_referrals_inviter ON referrals (inviter_id)")
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.referral_closure (
+                    ancestor_id INTEGER,
+                    descendant_id INTEGER,
+                    depth INTEGER,
+                    PRIMARY KEY (ancestor_id, descendant_id)
+                ) WITHOUT ROWID''')
+    c.execute(f"CREATE INDEX IF NOT EXISTS {SHARED}.idx_referral_closure_descendant ON referral_closure (descendant_id)")
+
+    # Directory of every user's username and invite code, for lookups across shards.
+    # With a single database it is just a view over users.
+    if SHARDED:
+        c.execute('''CREATE TABLE IF NOT EXISTS shared.directory (
+                        user_id INTEGER PRIMARY KEY,
+                        username TEXT UNIQUE,
+                        invite_code TEXT UNIQUE
+                    )''')
+    else:
+        c.execute("CREATE VIEW IF NOT EXISTS directory AS SELECT id AS user_id, username, invite_code FROM users")
+
+    # Company valuation: owners are accepted members too, and every accepted member row carries
+    # the member's holdings value, which the companies' value and team size are summed from
+    if add_column(c, 'company_members', 'value', 'REAL DEFAULT 0'):
+        c.execute("""INSERT OR IGNORE INTO company_members (company_id, user_id, role, status)
+                     SELECT id, owner_id, 'owner', 'accepted' FROM companies""")
+    c.execute(f"CREATE INDEX IF NOT EXISTS {SHARED}.idx_company_members_user ON company_members (user_id)")
+    # One company per owner, enforced for new companies. Duplicates that concurrent /create_company calls
+    # left earlier are kept, with their members and the fees paid for them, and logged for the admins.
+    c.execute(f"DROP INDEX IF EXISTS {SHARED}.idx_companies_owner_unique")
+    c.execute(f"CREATE INDEX IF NOT EXISTS {SHARED}.idx_companies_owner ON companies (owner_id)")
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS {SHARED}.companies_one_per_owner BEFORE INSERT ON companies
+                  WHEN EXISTS (SELECT 1 FROM companies WHERE owner_id = NEW.owner_id)
+                  BEGIN SELECT RAISE(ABORT, 'owner already has a company'); END""")
+    c.execute("SELECT id, owner_id FROM companies WHERE id NOT IN (SELECT MIN(id) FROM companies GROUP BY owner_id)")
+    for company_id, owner_id in c.fetchall():
+        logger.warning("Company %s is a second company of owner %s", company_id, owner_id)
+    c.execute("SELECT id, wealth - balance FROM users WHERE id IN (SELECT user_id FROM company_members WHERE status = 'accepted')")
+    revalue_companies(c, c.fetchall())
+
+    # Notification preferences and the log of market events that digests are built from
+    add_column(c, 'users', 'notify_mode', "TEXT DEFAULT 'instant'")
+    add_column(c, 'users', 'digest_minutes', f'INTEGER DEFAULT {DIGEST_DEFAULT_MINUTES}')
+    add_column(c, 'users', 'last_digest_at', 'REAL DEFAULT 0')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_notify ON users (notify_mode, last_digest_at)")
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {SHARED}.market_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL,
+                    product_id INTEGER,
+                    text TEXT
+                )''')
+    c.execute(f"CREATE INDEX IF NOT EXISTS {SHARED}.idx_market_events_ts ON market_events (ts)")
+
+    # Scheduled jobs of this worker: recurring jobs keep their next run across restarts, one-shot jobs their payload
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                    name TEXT PRIMARY KEY,
+                    job_type TEXT,
+                    run_at REAL,
+                    payload TEXT,
+                    last_run REAL,
+                    last_status TEXT
+                )''')
+
+    # Wealth of every user of this shard, one row per user per WEALTH_SNAPSHOT_INTERVAL
+    c.execute('''CREATE TABLE IF NOT EXISTS wealth_history (
+                    user_id INTEGER,
+                    bucket INTEGER,
+                    wealth REAL,
+                    PRIMARY KEY (user_id, bucket)
+                ) WITHOUT ROWID''')
+
+    # Append-only double-entry ledger of this shard's balances and holdings, see post_entry()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ledger'")
+    ledger_exists = c.fetchone() is not None
+    c.execute('''CREATE TABLE IF NOT EXISTS ledger (
+                    id INTEGER PRIMARY KEY,
+                    entry INTEGER,
+                    kind TEXT,
+                    account TEXT,
+                    user_id INTEGER,
+                    asset INTEGER,
+                    amount REAL,
+                    ts INTEGER
+                )''')
+    c.execute("CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END")
+    c.execute("CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger BEGIN SELECT RAISE(ABORT, 'ledger is append-only'); END")
+    if not ledger_exists:
+        # Existing balances and holdings become one opening entry, so the ledger replays to the current state
+        c.execute("""INSERT INTO ledger (entry, kind, account, user_id, asset, amount, ts)
+                     SELECT 1, 'opening', 'user', id, ?, balance, strftime('%s', 'now') FROM users""", (LEDGER_CASH,))
+        c.execute("""INSERT INTO ledger (entry, kind, account, user_id, asset, amount, ts)
+                     SELECT 1, 'opening', 'user', user_id, product_id, quantity, strftime('%s', 'now') FROM holdings""")
+        c.execute("""INSERT INTO ledger (entry, kind, account, user_id, asset, amount, ts)
+                     SELECT 1, 'opening', 'treasury', NULL, asset, -SUM(amount), strftime('%s', 'now')
+                     FROM ledger WHERE entry = 1 GROUP BY asset""")
+
+    # Start every product's history with its current price
+    c.execute("SELECT id, current_price FROM market WHERE id NOT IN (SELECT DISTINCT product_id FROM price_ticks)")
+    record_prices(c, c.fetchall())
+    c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
     conn.close()
 
+# Function to add a column to an existing table, returns True if the column was added
+def add_column(c, table, column, definition):
+    c.execute(f"PRAGMA table_info({table})")
+    if column in [row[1] for row in c.fetchall()]:
+        return False
+    c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
 # List of adjectives, names, and Roman numerals for generating random usernames
 adjectives = [
     "Furious", "Brave", "Cunning", "Wise", "Swift", "Mighty", "Bold", "Fearless", "Valiant", "Noble",
@@ -92,119 +818,569 @@ roman_numerals = [
     "XXI", "XXII", "XXIII", "XXIV", "XXV", "XXVI", "XXVII", "XXVIII", "XXIX", "XXX"
 ]
 
-# Function to generate a random username
-def generate_random_username():
-    while True:
-        base_username = f"{random.choice(adjectives)} {random.choice(names)}"
-        conn = sqlite3.connect('game.db')
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM users WHERE username LIKE ?", (f"{base_username}%",))
-        count = c.fetchone()[0]
-        conn.close()
-        if count == 0:
-            return base_username
-        else:
-            base_username = f"{base_username} {roman_numerals[count % len(roman_numerals)]}"
-            c = conn.cursor()
-            c.execute("SELECT COUNT(*) FROM users WHERE username = ?", (base_username,))
-            if c.fetchone()[0] == 0:
-                return base_username
+# Function to format the n-th username for a base name: "Brave Mark", "Brave Mark II", ..., "Brave Mark XXX", "Brave Mark 31"
+def numbered_username(base_username, n):
+    if n == 1:
+        return base_username
+    if n <= len(roman_numerals):
+        return f"{base_username} {roman_numerals[n - 1]}"
+    return f"{base_username} {n}"
+
+# Function to generate a unique random username, using an open cursor.
+# One upsert on the base name's counter yields the next free number, so there is no retry loop.
+# Generated names always contain a space, which Telegram and /username names cannot, so they never collide.
+def generate_random_username(c):
+    base_username = f"{random.choice(adjectives)} {random.choice(names)}"
+    c.execute("""INSERT INTO username_counters (base, next) VALUES (?, 1)
+                 ON CONFLICT (base) DO UPDATE SET next = next + 1 RETURNING next""", (base_username,))
+    return numbered_username(base_username, c.fetchone()[0])
+
+# Function to prepare existing users for the unique username index, using an open cursor.
+# Duplicate names get the user ID appended and the counters start after the generated names already in use.
+def migrate_usernames(c):
+    c.execute("""UPDATE users SET username = username || ' ' || id
+                 WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY username) AND username IS NOT NULL""")
+    suffixes = {numeral: i for i, numeral in enumerate(roman_numerals, start=1)}
+    bases = {f"{adjective} {name}" for adjective in adjectives for name in names}
+    counters = {}
+    c.execute("SELECT username FROM users WHERE username LIKE '% %'")
+    for (existing,) in c.fetchall():
+        words = existing.split(' ')
+        base_username = ' '.join(words[:2])
+        if base_username not in bases:
+            continue
+        suffix = words[2] if len(words) == 3 else None
+        n = 1 if suffix is None else suffixes.get(suffix) or (int(suffix) if suffix.isdigit() else 0)
+        counters[base_username] = max(counters.get(base_username, 0), n)
+    c.executemany("INSERT OR REPLACE INTO username_counters (base, next) VALUES (?, ?)", counters.items())
 
 # Function to generate a unique invite link
-def generate_invite_link(user_id):
-    unique_id = str(uuid.uuid4())[:8]  # Generate unique ID and shorten to 8 characters
-    return f"https://t.me/WolfsofTonStreet_bot?start={unique_id}"
+def generate_invite_link(invite_code):
+    return f"https://t.me/WolfsofTonStreet_bot?start={invite_code}"
 
-# Function to calculate user's total wealth
-def calculate_wealth(user_id):
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT balance, portfolio FROM users WHERE id = ?", (user_id,))
-    user_data = c.fetchone()
-    balance = user_data[0]
-    portfolio = json.loads(user_data[1])
-    total_value = balance
-
-    for product_id, quantity in portfolio.items():
-        c.execute("SELECT current_price FROM market WHERE id = ?", (product_id,))
-        product_price = c.fetchone()[0]
-        total_value += product_price * quantity
+# Function to generate an unused invite code, using an open cursor
+def generate_invite_code(c):
+    while True:
+        invite_code = str(uuid.uuid4())[:8]  # Generate unique ID and shorten to 8 characters
+        c.execute("SELECT 1 FROM directory WHERE invite_code = ?", (invite_code,))
+        if not c.fetchone():
+            return invite_code
+
+# Function to add or rename a user in the shared directory, using an open cursor.
+# Raises sqlite3.IntegrityError when the username is taken on any shard.
+def update_directory(c, user_id, username, invite_code=None):
+    if SHARDED:
+        c.execute("""INSERT INTO directory (user_id, username, invite_code) VALUES (?, ?, ?)
+                     ON CONFLICT (user_id) DO UPDATE SET username = excluded.username""", (user_id, username, invite_code))
+
+# Ledger asset of money; other assets are product IDs, counted in units held
+LEDGER_CASH = 0
+# Largest difference between a replayed and a live amount that is still rounding, not drift
+LEDGER_TOLERANCE = 0.005
+
+# Function to append one balanced entry to the ledger, using an open cursor.
+# Takes [(account, user_id, asset, amount), ...]; 'user' postings move a user's balance or holdings,
+# the other accounts (market, treasury, companies) are the game's side, so every asset sums to zero.
+def post_entry(c, kind, postings):
+    c.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM ledger")
+    entry = c.fetchone()[0]
+    ts = int(time.time())
+    c.executemany("INSERT INTO ledger (entry, kind, account, user_id, asset, amount, ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                  [(entry, kind, account, user_id, asset, amount, ts) for account, user_id, asset, amount in postings])
+
+# Function to credit the referral bonus, using an open cursor on the inviter's shard
+def credit_referral_bonus(c, inviter_id):
+    c.execute("UPDATE users SET balance = balance + 1000 WHERE id = ?", (inviter_id,))
+    if c.rowcount:
+        post_entry(c, 'referral_bonus', [('user', inviter_id, LEDGER_CASH, 1000.0), ('treasury', None, LEDGER_CASH, -1000.0)])
+    refresh_wealth(c, inviter_id)
+
+# Function to record that inviter_id referred invitee_id, using an open cursor.
+# The closure table gets the new user as a descendant of the inviter and of all the inviter's ancestors.
+def record_referral(c, inviter_id, invitee_id):
+    c.execute("INSERT INTO referrals (invitee_id, inviter_id, created_at) VALUES (?, ?, datetime('now'))", (invitee_id, inviter_id))
+    c.execute("""INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+                 SELECT ancestor_id, ?, depth + 1 FROM referral_closure WHERE descendant_id = ?
+                 UNION ALL SELECT ?, ?, 1""", (invitee_id, inviter_id, inviter_id, invitee_id))
+
+# Immutable view of the market table. Handlers read prices, names and availability from the
+# current snapshot instead of querying; writers replace it as a whole with a higher version.
+# Products per page of the market listing and of the buy screen; Telegram caps a message at 4096 characters
+MARKET_LISTING_PAGE_SIZE = 25
+MARKET_BUY_PAGE_SIZE = 10
+
+# Function to build the "< Previous" / "Next >" row of a paged screen, with callback data <prefix>_<page>.
+# Empty when there is only one page.
+def page_navigation(prefix, page, total_pages):
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("< Previous", callback_data=f'{prefix}_{page - 1}'))
+    if page < total_pages - 1:
+        navigation.append(InlineKeyboardButton("Next >", callback_data=f'{prefix}_{page + 1}'))
+    return navigation
+
+class MarketSnapshot:
+    def __init__(self, version, products):
+        self.version = version
+        self.products = products  # Tuple of (id, name, current_price, availability) ordered by id
+        self.by_id = {product[0]: product for product in products}
+        self._listing = {}
+        self._buy_keyboard = {}
+
+    def page_count(self, page_size):
+        return max(1, -(-len(self.products) // page_size))
+
+    # Returns the page number clamped to the existing pages and the products on it
+    def page(self, page, page_size):
+        page = min(max(int(page), 0), self.page_count(page_size) - 1)
+        return page, self.products[page * page_size:(page + 1) * page_size]
+
+    # One page of the market listing: (text, keyboard), rendered once per snapshot and page
+    def listing(self, page=0):
+        page, products = self.page(page, MARKET_LISTING_PAGE_SIZE)
+        if page not in self._listing:
+            total_pages = self.page_count(MARKET_LISTING_PAGE_SIZE)
+            title = f'Available products on the market (page {page + 1}/{total_pages}):' if total_pages > 1 else 'Available products on the market:'
+            text = title + '\n' + '\n'.join(
+                f'ID: {product[0]}, Name: {product[1]}, Price: {product[2]}, Availability: {product[3]}' for product in products)
+            navigation = page_navigation('market', page, total_pages)
+            self._listing[page] = (text, InlineKeyboardMarkup(([navigation] if navigation else []) + [BACK_TO_MENU_ROW]))
+        return self._listing[page]
+
+    # One page of the keyboard with purchase buttons, built once per snapshot and page
+    def buy_keyboard(self, page=0):
+        page, products = self.page(page, MARKET_BUY_PAGE_SIZE)
+        if page not in self._buy_keyboard:
+            keyboard = []
+            for product in products:
+                row = [InlineKeyboardButton(f'Buy {product[1]} - {product[2]}', callback_data=f'buy_{product[0]}')]
+                row += [InlineKeyboardButton(f'x{quantity}', callback_data=f'buy_{product[0]}_{quantity}') for quantity in QUANTITY_BUTTONS]
+                keyboard.append(row)
+            navigation = page_navigation('show_market', page, self.page_count(MARKET_BUY_PAGE_SIZE))
+            if navigation:
+                keyboard.append(navigation)
+            keyboard.append(BACK_TO_MENU_ROW)
+            self._buy_keyboard[page] = InlineKeyboardMarkup(keyboard)
+        return self._buy_keyboard[page]
+
+    # Returns the product row, or None for unknown or malformed IDs
+    def get(self, product_id):
+        try:
+            return self.by_id.get(int(product_id))
+        except (TypeError, ValueError):
+            return None
+
+    # Returns the product row for an ID or a case-insensitive name, as typed in commands
+    def find(self, name_or_id):
+        product = self.get(name_or_id)
+        if product:
+            return product
+        name = str(name_or_id).lower()
+        return next((product for product in self.products if product[1].lower() == name), None)
+
+class MarketCache:
+    def __init__(self):
+        self.snapshot = MarketSnapshot(0, ())
+        self._lock = threading.Lock()
+
+    # Function to re-read market rows, using an open cursor. Returns the rows read.
+    # Called inside the transaction that changed them, so the snapshot matches what is being committed;
+    # the new snapshot is published once that transaction commits.
+    def refresh(self, c, *product_ids):
+        if product_ids:
+            c.execute(f"SELECT id, name, current_price, availability FROM market WHERE id IN ({','.join('?' * len(product_ids))})",
+                      [int(product_id) for product_id in product_ids])
+        else:
+            c.execute("SELECT id, name, current_price, availability FROM market")
+        rows = c.fetchall()
+        after_commit(self._publish, rows, bool(product_ids))
+        return rows
+
+    def _publish(self, rows, partial):
+        with self._lock:
+            by_id = dict(self.snapshot.by_id) if partial else {}
+            by_id.update((row[0], row) for row in rows)
+            self.snapshot = MarketSnapshot(self.snapshot.version + 1, tuple(by_id[key] for key in sorted(by_id)))
+
+market_cache = MarketCache()
+
+USER_CACHE_SIZE = 100000
+USER_CACHE_BYTES = 64 * 1024 * 1024
+USER_CACHE_TTL = 120  # Seconds; also bounds how long a referral bonus credited by another worker stays unseen
+
+# What the menu, portfolio and profile screens show of a user; holdings are ((product_id, quantity), ...)
+UserProfile = collections.namedtuple('UserProfile', 'balance holdings username invite_link')
+
+PROFILE_SQL = ("SELECT u.balance, u.username, u.invite_link, h.product_id, h.quantity FROM users u "
+               "LEFT JOIN holdings h ON h.user_id = u.id WHERE u.id = ? ORDER BY h.product_id")
+
+# Function to read a user's profile, using an open cursor. Returns None for unknown users.
+def load_profile(c, user_id):
+    c.execute(PROFILE_SQL, (user_id,))
+    return profile_from_rows(c.fetchall())
+
+# Function to build a UserProfile from the rows of PROFILE_SQL
+def profile_from_rows(rows):
+    if not rows:
+        return None
+    balance, username, invite_link = rows[0][:3]
+    holdings = tuple((product_id, quantity) for *_, product_id, quantity in rows if product_id is not None)
+    return UserProfile(balance, holdings, username, invite_link)
+
+# LRU cache of user profiles, bounded by entry count and approximate size, with entries expiring after USER_CACHE_TTL.
+# Writers put the profile they committed (write-through) or invalidate it. A read that missed fills the
+# entry only if no write for that user happened while it was reading, so an older row never replaces a newer one.
+class UserCache:
+    def __init__(self, max_entries=USER_CACHE_SIZE, max_bytes=USER_CACHE_BYTES, ttl=USER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = collections.OrderedDict()  # user_id -> (expires_at, cost, profile)
+        self._fills = {}  # user_id -> token of the read allowed to fill the entry
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cost(profile):
+        return (sys.getsizeof(profile) + sys.getsizeof(profile.holdings) + 64 * len(profile.holdings)
+                + sys.getsizeof(profile.username) + sys.getsizeof(profile.invite_link))
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] < time.monotonic():
+                self._discard(user_id)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+        metrics.inc('bot_user_cache_total', (('result', 'hit' if entry is not None else 'miss'),))
+        return entry[2] if entry is not None else None
+
+    # Returns a token for a read that may fill the entry of user_id with fill()
+    def begin_fill(self, user_id):
+        token = object()
+        with self._lock:
+            self._fills[user_id] = token
+        return token
+
+    def fill(self, user_id, profile, token):
+        with self._lock:
+            if self._fills.get(user_id) is token:
+                del self._fills[user_id]
+                self._store(user_id, profile)
+
+    # Stores a profile just committed by a writer
+    def put(self, user_id, profile):
+        with self._lock:
+            self._fills.pop(user_id, None)
+            self._store(user_id, profile)
+
+    # Changes fields of a cached profile after a write that touched only them
+    def update(self, user_id, **fields):
+        with self._lock:
+            self._fills.pop(user_id, None)
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._store(user_id, entry[2]._replace(**fields))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._fills.pop(user_id, None)
+            self._discard(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._fills.clear()
+            self._entries.clear()
+            self.size = 0
+
+    def _discard(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def _store(self, user_id, profile):
+        self._discard(user_id)
+        if profile is None:
+            return
+        cost = self._cost(profile)
+        self._entries[user_id] = (time.monotonic() + self.ttl, cost, profile)
+        self.size += cost
+        while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+            self.size -= self._entries.popitem(last=False)[1][1]
+        metrics.set('bot_user_cache_entries', len(self._entries))
+
+user_cache = UserCache()
+
+# Function to get a user's profile, from the cache when possible. Returns None for unknown users.
+async def user_profile(user_id):
+    profile = user_cache.get(user_id)
+    if profile is None:
+        token = user_cache.begin_fill(user_id)
+        profile = profile_from_rows(await db.fetchall(PROFILE_SQL, (user_id,)))
+        user_cache.fill(user_id, profile, token)
+    return profile
 
-    conn.close()
-    return total_value, balance
+# Function to calculate user's total wealth
+async def calculate_wealth(user_id):
+    profile = await user_profile(user_id)
+    if profile is None:
+        return None, None
+    snapshot = market_cache.snapshot
+    total_value = profile.balance + sum(snapshot.by_id[product_id][2] * quantity for product_id, quantity in profile.holdings)
+    return total_value, profile.balance
+
+# SQL expression computing the wealth of the current `users` row (balance + holdings at market prices)
+WEALTH_SQL = ("balance + COALESCE((SELECT SUM(m.current_price * h.quantity) FROM holdings h "
+              "JOIN market m ON m.id = h.product_id WHERE h.user_id = users.id), 0)")
+
+RANKING_PAGE_SIZE = 10
+LEADERBOARD_BULK_THRESHOLD = 64  # Above this many changes, update_many() rebuilds the sorted keys once
+
+# In-memory leaderboard ordered by wealth.
+# Entries are kept in a sorted list of (-wealth, user_id) keys, so top N and pages are slices
+# and a user's rank is a binary search. Updates come from database worker threads, hence the lock.
+class Leaderboard:
+    def __init__(self):
+        self._keys = []
+        self._wealth = {}
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        with self._lock:
+            self._wealth = {user_id: wealth for user_id, wealth in rows}
+            self._keys = sorted((-wealth, user_id) for user_id, wealth in self._wealth.items())
+
+    def update(self, user_id, wealth):
+        with self._lock:
+            old = self._wealth.get(user_id)
+            if old is not None:
+                if old == wealth:
+                    return
+                del self._keys[bisect.bisect_left(self._keys, (-old, user_id))]
+            self._wealth[user_id] = wealth
+            bisect.insort(self._keys, (-wealth, user_id))
+
+    # Applies [(user_id, wealth), ...] at once. Small batches go through update(); larger ones drop the
+    # changed keys in one pass and let the sort merge the new keys into the already sorted rest,
+    # O(N + k log k) instead of O(k * N) for k changes.
+    def update_many(self, changes):
+        if len(changes) <= LEADERBOARD_BULK_THRESHOLD:
+            for user_id, wealth in changes:
+                self.update(user_id, wealth)
+            return
+        with self._lock:
+            changed = {user_id: wealth for user_id, wealth in changes if self._wealth.get(user_id) != wealth}
+            if not changed:
+                return
+            keys = [key for key in self._keys if key[1] not in changed]
+            keys += sorted((-wealth, user_id) for user_id, wealth in changed.items())
+            keys.sort()  # Two sorted runs, merged in linear time
+            self._keys = keys
+            self._wealth.update(changed)
+
+    def remove(self, user_id):
+        with self._lock:
+            old = self._wealth.pop(user_id, None)
+            if old is not None:
+                del self._keys[bisect.bisect_left(self._keys, (-old, user_id))]
+
+    def __len__(self):
+        return len(self._keys)
+
+    # Returns 1-based rank of the user, or None if the user is not on the leaderboard
+    def rank(self, user_id):
+        wealth = self._wealth.get(user_id)
+        if wealth is None:
+            return None
+        return bisect.bisect_left(self._keys, (-wealth, user_id)) + 1
+
+    def wealth(self, user_id):
+        return self._wealth.get(user_id)
+
+    # Returns [(user_id, wealth), ...] for the given slice of the ranking
+    def top(self, n, offset=0):
+        return [(user_id, -neg_wealth) for neg_wealth, user_id in self._keys[offset:offset + n]]
+
+    def page(self, page, page_size=RANKING_PAGE_SIZE):
+        return self.top(page_size, page * page_size)
+
+leaderboard = Leaderboard()
+# Companies ranked by their precomputed value, same structure keyed by company ID
+company_ranking = Leaderboard()
+
+# Function to load the leaderboard from the stored wealth column
+# In multi-worker mode every worker keeps the ranking of all shards: its own users are updated
+# as they trade, the others are reloaded every LEADERBOARD_SYNC_INTERVAL by sync_shared_state().
+async def load_leaderboard():
+    rows = []
+    for database in all_databases():
+        rows += await database.fetchall("SELECT id, wealth FROM users")
+    leaderboard.load(rows)
+    company_ranking.load(await db.fetchall("SELECT id, value FROM companies"))
+
+# Function to recompute and store the wealth of the given users, using an open cursor
+def refresh_wealth(c, *user_ids):
+    wealths = []
+    holdings_values = []
+    for user_id in user_ids:
+        c.execute(f"UPDATE users SET wealth = {WEALTH_SQL} WHERE id = ? RETURNING wealth, wealth - balance", (user_id,))
+        row = c.fetchone()
+        if row:
+            wealths.append((user_id, row[0]))
+            holdings_values.append((user_id, row[1]))
+    after_commit(leaderboard.update_many, wealths)
+    revalue_companies(c, holdings_values)
+
+# Price of each product when the holders on this shard were last repriced, by product id. Trades
+# publish new prices to the market snapshot without repricing anyone, so sync_market() compares
+# the shared market against these, not against the snapshot.
+repriced_prices = {}
+
+# Function to recompute the wealth of every holder of the given products after their prices changed
+def reprice_holders(c, *product_ids):
+    placeholders = ','.join('?' * len(product_ids))
+    c.execute(f"""UPDATE users SET wealth = {WEALTH_SQL}
+                  WHERE id IN (SELECT user_id FROM holdings WHERE product_id IN ({placeholders}))
+                  RETURNING id, wealth, wealth - balance""",
+              product_ids)
+    rows = c.fetchall()
+    after_commit(leaderboard.update_many, [(user_id, wealth) for user_id, wealth, _ in rows])
+    revalue_companies(c, [(user_id, holdings_value) for user_id, _, holdings_value in rows])
+    c.execute(f"SELECT id, current_price FROM market WHERE id IN ({placeholders})", product_ids)
+    after_commit(repriced_prices.update, c.fetchall())
+
+# Function to carry members' new holdings values into their companies, using an open cursor.
+# Takes [(user_id, holdings_value), ...]; only companies with one of these users as an accepted member are touched.
+def revalue_companies(c, holdings_values):
+    if not holdings_values:
+        return
+    c.execute("""UPDATE company_members SET value = json_extract(t.value, '$[1]')
+                 FROM json_each(?) t WHERE company_members.user_id = json_extract(t.value, '$[0]') AND status = 'accepted'
+                 RETURNING company_id""", (json.dumps(holdings_values),))
+    update_company_values(c, *{row[0] for row in c.fetchall()})
+
+# Function to recompute the value and team size of the given companies from their member rows, using an open cursor
+def update_company_values(c, *company_ids):
+    if not company_ids:
+        return
+    c.execute(f"""UPDATE companies SET
+                      value = (SELECT TOTAL(value) FROM company_members WHERE company_id = companies.id AND status = 'accepted'),
+                      team = (SELECT COUNT(*) FROM company_members WHERE company_id = companies.id AND status = 'accepted')
+                  WHERE id IN ({','.join('?' * len(company_ids))}) RETURNING id, value""", company_ids)
+    after_commit(company_ranking.update_many, c.fetchall())
+
+# Static texts and keyboards, built once and reused by every screen
+MENU_TEXT = (
+    "Welcome to the Wolfs of Ton Street game! 🎉\n\n"
+    "Your total wealth: {total_wealth:.2f} units\n"
+    "Your balance: {balance:.2f} units\n\n"
+    "Game rules are simple:\n"
+    "1. You start with a balance of 1000 units.\n"
+    "2. You can buy and sell various products available on the market.\n"
+    "3. Product prices may change due to random economic events.\n"
+    "4. Your goal is to increase your wealth through wise investments.\n"
+    "5. Receive 1000 units for each referral through /referral.\n\n"
+    "To know more, use /how_to_play\n\n"
+    "Choose one of the options below to start:"
+)
+MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Buy product", callback_data='show_market')],
+    [InlineKeyboardButton("Market", callback_data='market')],
+    [InlineKeyboardButton("Portfolio", callback_data='portfolio')],
+    [InlineKeyboardButton("Create Company", callback_data='create_company')],
+    [InlineKeyboardButton("Web App", web_app=WebAppInfo(url="https://wolfsonton.netlify.app/"))]
+])
+BACK_TO_MENU_ROW = [InlineKeyboardButton("Back to menu", callback_data='menu')]
+BACK_TO_MENU_KEYBOARD = InlineKeyboardMarkup([BACK_TO_MENU_ROW])
+SHOW_MARKET_TEXT = 'Choose a product to buy, or use /buy <product> <quantity>:'
+
+# Function to show a screen: commands get a new message, button presses edit the pressed message in place.
+# Nothing is sent when the message already shows the same text and keyboard.
+async def show(update, text, reply_markup=None):
+    if update.message:
+        await update.message.reply_text(text, reply_markup=reply_markup)
+        return
+    message = update.callback_query.message
+    if message.text is None:
+        # Photos and other media cannot become text messages, so answer below them
+        await message.reply_text(text, reply_markup=reply_markup)
+        return
+    if message.text == text.strip() and message.reply_markup == reply_markup:
+        return
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except telegram.error.BadRequest as e:
+        if 'message is not modified' not in str(e).lower():
+            raise
 
 # Function to display the menu with buttons
 async def menu(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    total_wealth, balance = calculate_wealth(user_id)
-
-    intro_text = (
-        f"Welcome to the Wolfs of Ton Street game! 🎉\n\n"
-        f"Your total wealth: {total_wealth:.2f} units\n"
-        f"Your balance: {balance:.2f} units\n\n"
-        "Game rules are simple:\n"
-        "1. You start with a balance of 1000 units.\n"
-        "2. You can buy and sell various products available on the market.\n"
-        "3. Product prices may change due to random economic events.\n"
-        "4. Your goal is to increase your wealth through wise investments.\n"
-        "5. Receive 1000 units for each referral through /referral.\n\n"
-        "To know more, use /how_to_play\n\n"
-        "Choose one of the options below to start:"
-    )
-
-    keyboard = [
-        [InlineKeyboardButton("Buy product", callback_data='show_market')],
-        [InlineKeyboardButton("Market", callback_data='market')],
-        [InlineKeyboardButton("Portfolio", callback_data='portfolio')],
-        [InlineKeyboardButton("Create Company", callback_data='create_company')],
-        [InlineKeyboardButton("Web App", web_app=WebAppInfo(url="https://wolfsonton.netlify.app/"))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    total_wealth, balance = await calculate_wealth(user_id)
+    await show(update, MENU_TEXT.format(total_wealth=total_wealth, balance=balance), MENU_KEYBOARD)
 
-    if update.message:
-        await update.message.reply_text(intro_text, reply_markup=reply_markup)
-    elif update.callback_query:
-        await update.callback_query.message.reply_text(intro_text, reply_markup=reply_markup)
+# Function to register a new user, using an open cursor.
+# Returns (user_exists, username, invite_link, inviter_id).
+def register_user(c, user_id, username, invite_id):
+    # Check if the user already exists; a returning user who blocked the bot gets broadcasts again
+    c.execute("SELECT id FROM users WHERE id = ?", (user_id,))
+    if c.fetchone():
+        c.execute("UPDATE users SET blocked = 0 WHERE id = ? AND blocked = 1", (user_id,))
+        return True, username, None, None
+
+    if not username:
+        username = generate_random_username(c)
+
+    invite_code = generate_invite_code(c)
+    invite_link = generate_invite_link(invite_code)
+    try:
+        update_directory(c, user_id, username, invite_code)
+        c.execute("INSERT INTO users (id, username, invite_link, invite_code) VALUES (?, ?, ?, ?) RETURNING wealth, balance",
+                  (user_id, username, invite_link, invite_code))
+    except sqlite3.IntegrityError:
+        # Someone already took this Telegram username with /username
+        username = generate_random_username(c)
+        update_directory(c, user_id, username, invite_code)
+        c.execute("INSERT INTO users (id, username, invite_link, invite_code) VALUES (?, ?, ?, ?) RETURNING wealth, balance",
+                  (user_id, username, invite_link, invite_code))
+    wealth, balance = c.fetchone()
+    after_commit(leaderboard.update, user_id, wealth)
+    post_entry(c, 'signup', [('user', user_id, LEDGER_CASH, balance), ('treasury', None, LEDGER_CASH, -balance)])
+
+    inviter_id = None
+    if invite_id:
+        # Find the inviting user and update their balance; an inviter on another shard is credited by start()
+        c.execute("SELECT user_id FROM directory WHERE invite_code = ?", (invite_id,))
+        inviter = c.fetchone()
+        if inviter:
+            inviter_id = inviter[0]
+            record_referral(c, inviter_id, user_id)
+            if shard_of(inviter_id) == WORKER_INDEX:
+                credit_referral_bonus(c, inviter_id)
+
+    return False, username, invite_link, inviter_id
 
 # Function to handle the /start command with buttons
 async def start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    username = update.effective_user.username
-
-    if not username:
-        username = generate_random_username()
-
     args = context.args
     invite_id = args[0] if args else None
 
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-
-    # Check if the user already exists
-    c.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    user_exists = c.fetchone()
-
+    user_exists, username, invite_link, inviter_id = await db.group_commit(
+        register_user, user_id, update.effective_user.username, invite_id)
+    if inviter_id and shard_of(inviter_id) != WORKER_INDEX:
+        await database_for(inviter_id).group_commit(credit_referral_bonus, inviter_id)
     if not user_exists:
-        invite_link = generate_invite_link(user_id)
-        c.execute("INSERT INTO users (id, username, invite_link) VALUES (?, ?, ?)", (user_id, username, invite_link))
+        user_cache.invalidate(user_id)
+    if inviter_id:
+        user_cache.invalidate(inviter_id)
 
-        if invite_id:
-            # Find the inviting user and update their balance
-            c.execute("SELECT id FROM users WHERE invite_link LIKE ?", (f"%{invite_id}",))
-            inviter = c.fetchone()
-            if inviter:
-                inviter_id = inviter[0]
-                c.execute("UPDATE users SET balance = balance + 1000 WHERE id = ?", (inviter_id,))
-                await update.message.reply_text(f"You were invited by user with ID {inviter_id}. They receive 1000 units for the invitation!")
+    if inviter_id:
+        await update.message.reply_text(f"You were invited by user with ID {inviter_id}. They receive 1000 units for the invitation!")
 
-                # Send notification to the inviting user
-                await context.bot.send_message(chat_id=inviter_id, text=f"User {username} has joined the game using your invite link! You receive 1000 units.")
-
-        conn.commit()
-
-
-
-    conn.close()
+        # Send notification to the inviting user
+        await context.bot.send_message(chat_id=inviter_id, text=f"User {username} has joined the game using your invite link! You receive 1000 units.")
 
     await menu(update, context)
     if not user_exists:
@@ -233,42 +1409,37 @@ async def how_to_play(update: Update, context: CallbackContext) -> None:
 # Function to handle the /referral command displaying the user's invite link
 async def referral(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
+    profile = await user_profile(user_id)
 
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT invite_link FROM users WHERE id = ?", (user_id,))
-    invite_link = c.fetchone()
-    conn.close()
-
-    if invite_link:
+    if profile and profile.invite_link:
         photo_url = 'https://wolfsonton.com/files/referral_pic.png'  # Replace with your image URL
-        await context.bot.send_photo(chat_id=update.message.chat_id, photo=photo_url, caption=f"Your invite link: {invite_link[0]}")
+        await context.bot.send_photo(chat_id=update.message.chat_id, photo=photo_url, caption=f"Your invite link: {profile.invite_link}")
     else:
         await update.message.reply_text("Invite link not found.")
 
-# Function to handle the /ranking command displaying the user ranking
-async def ranking(update: Update, context: CallbackContext) -> None:
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT id, username FROM users")
-    users = c.fetchall()
+# Function to handle the /ranking command displaying a page of the user ranking
+async def ranking(update: Update, context: CallbackContext, page=0) -> None:
+    user_id = update.effective_user.id
+    total_pages = max(1, -(-len(leaderboard) // RANKING_PAGE_SIZE))
+    page = min(max(int(page), 0), total_pages - 1)
+    entries = leaderboard.page(page)
 
-    user_wealth = []
-    for user in users:
-        user_id, username = user
-        wealth, _ = calculate_wealth(user_id)
-        user_wealth.append((username, wealth))
+    # Fetch usernames only for the users shown on this page
+    user_ids = [entry_id for entry_id, _ in entries]
+    usernames = dict(await db.fetchall(f"SELECT user_id, username FROM directory WHERE user_id IN ({','.join('?' * len(user_ids))})", user_ids))
 
-    user_wealth.sort(key=lambda x: x[1], reverse=True)
-    ranking_text = "User ranking:\n"
-    for i, (username, wealth) in enumerate(user_wealth, start=1):
-        ranking_text += f"{i}. {username}: {wealth:.2f} units\n"
+    ranking_text = f"User ranking (page {page + 1}/{total_pages}):\n"
+    for i, (entry_id, wealth) in enumerate(entries, start=page * RANKING_PAGE_SIZE + 1):
+        ranking_text += f"{i}. {usernames.get(entry_id)}: {wealth:.2f} units\n"
 
-    keyboard = [[InlineKeyboardButton("Back to menu", callback_data='menu')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    rank = leaderboard.rank(user_id)
+    if rank:
+        ranking_text += f"\nYour rank: {rank} of {len(leaderboard)} ({leaderboard.wealth(user_id):.2f} units)"
 
-    await update.message.reply_text(ranking_text, reply_markup=reply_markup)
-    conn.close()
+    navigation = page_navigation('ranking', page, total_pages)
+    keyboard = [navigation] if navigation else []
+    keyboard.append(BACK_TO_MENU_ROW)
+    await show(update, ranking_text, InlineKeyboardMarkup(keyboard))
 
 # Handler to handle callback queries from buttons
 async def button(update: Update, context: CallbackContext) -> None:
@@ -276,217 +1447,851 @@ async def button(update: Update, context: CallbackContext) -> None:
     await query.answer()
     data = query.data
     if data.startswith('buy_'):
-        _, product_id = data.split('_')
-        await buy(update, context, product_id)
+        # buy_<product_id> or buy_<product_id>_<quantity>
+        _, product_id, *quantity = data.split('_')
+        await buy(update, context, product_id, quantity[0] if quantity else 1)
     elif data.startswith('sell_'):
-        _, product_id = data.split('_')
-        await sell(update, context, product_id)
+        _, product_id, *quantity = data.split('_')
+        await sell(update, context, product_id, quantity[0] if quantity else 1)
     elif data == 'market':
         await market(update, context)
+    elif data.startswith('market_'):
+        _, page = data.split('_')
+        await market(update, context, page)
     elif data == 'portfolio':
         await portfolio(update, context)
     elif data == 'show_market':
         await show_market(update, context)
+    elif data.startswith('show_market_'):
+        await show_market(update, context, data.rsplit('_', 1)[1])
     elif data == 'menu':
         await menu(update, context)
     elif data == 'company_members':
         await show_company_members(update, context)
+    elif data.startswith('ranking_'):
+        _, page = data.split('_')
+        await ranking(update, context, page)
+    elif data.startswith('trades_'):
+        _, before_id = data.split('_')
+        await history_trades(update, context, before_id)
+    elif data.startswith('notify_'):
+        _, mode = data.split('_')
+        await notifications(update, context, mode)
+
+# Function to display a page of the market
+async def market(update: Update, context: CallbackContext, page=0) -> None:
+    await show(update, *market_cache.snapshot.listing(page))
+
+# Function to display a page of products on the market with purchase buttons
+async def show_market(update: Update, context: CallbackContext, page=0) -> None:
+    await show(update, SHOW_MARKET_TEXT, market_cache.snapshot.buy_keyboard(page))
+
+# Order limits and the quantities offered as buttons
+MAX_ORDER_QUANTITY = 1000000
+QUANTITY_BUTTONS = [10, 100]
+
+# Raised inside an order transaction to reject the whole batch
+class OrderError(Exception):
+    pass
+
+# Function to parse a quantity typed by the user or sent in callback data
+def parse_quantity(quantity):
+    try:
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        raise OrderError('Quantity must be a whole number.')
+    if quantity <= 0 or quantity > MAX_ORDER_QUANTITY:
+        raise OrderError(f'Quantity must be between 1 and {MAX_ORDER_QUANTITY}.')
+    return quantity
+
+# Function to execute a purchase, using an open cursor. Returns (product_name, quantity, total_cost).
+# Stock and balance are checked by the UPDATE statements themselves, so concurrent orders
+# can never oversell the market or overdraw the user.
+def execute_buy(c, user_id, product_id, quantity):
+    product = market_cache.snapshot.get(product_id)
 
-# Function to display the market
-async def market(update: Update, context: CallbackContext) -> None:
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT id, name, current_price, availability FROM market")
-    products = c.fetchall()
-    message_text = 'Available products on the market:\n' + '\n'.join([f'ID: {product[0]}, Name: {product[1]}, Price: {product[2]}, Availability: {product[3]}' for product in products])
-    keyboard = [[InlineKeyboardButton("Back to menu", callback_data='menu')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.callback_query.message.reply_text(message_text, reply_markup=reply_markup)
-    conn.close()
-
-# Function to display products on the market with purchase buttons
-async def show_market(update: Update, context: CallbackContext) -> None:
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT id, name, current_price, availability FROM market")
-    products = c.fetchall()
-    conn.close()
-
-    keyboard = []
-    for product in products:
-        keyboard.append([InlineKeyboardButton(f'Buy {product[1]} - {product[2]}', callback_data=f'buy_{product[0]}')])
-    keyboard.append([InlineKeyboardButton("Back to menu", callback_data='menu')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.callback_query.message.reply_text('Choose a product to buy:', reply_markup=reply_markup)
-
-# Function to handle product purchase
-async def buy(update: Update, context: CallbackContext, product_id) -> None:
-    user_id = update.callback_query.from_user.id
-    quantity = 1  # Can be adjusted if we want to allow purchasing more than one unit at a time
-
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT current_price, availability FROM market WHERE id = ?", (product_id,))
-    product = c.fetchone()
+    if not product:
+        raise OrderError('Product does not exist.')
+
+    product_id, product_name, _, _ = product
+
+    c.execute("UPDATE market SET availability = availability - ? WHERE id = ? AND availability >= ? RETURNING current_price",
+              (quantity, product_id, quantity))
+    row = c.fetchone()
+    if row is None:
+        raise OrderError(f'Not enough {product_name} available on the market.')
+    price = row[0]
+    total_cost = price * quantity
+
+    c.execute("UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?", (total_cost, user_id, total_cost))
+    if c.rowcount == 0:
+        c.execute("SELECT 1 FROM users WHERE id = ?", (user_id,))
+        raise OrderError('Insufficient funds.' if c.fetchone() else 'User not found.')
+
+    # Update holdings
+    c.execute("""INSERT INTO holdings (user_id, product_id, quantity) VALUES (?, ?, ?)
+                 ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity""",
+              (user_id, product_id, quantity))
+    c.execute("INSERT INTO transactions (user_id, type, product_id, amount, price, date) VALUES (?, 'buy', ?, ?, ?, datetime('now'))", (user_id, product_id, quantity, price))
+    post_entry(c, 'buy', [('user', user_id, LEDGER_CASH, -total_cost), ('market', None, LEDGER_CASH, total_cost),
+                          ('user', user_id, product_id, quantity), ('market', None, product_id, -quantity)])
+    return product_name, quantity, total_cost
+
+# Function to execute a sale, using an open cursor. Returns (product_name, quantity, total_revenue).
+def execute_sell(c, user_id, product_id, quantity):
+    product = market_cache.snapshot.get(product_id)
 
     if not product:
-        await update.callback_query.message.reply_text('Product does not exist.')
-        conn.close()
-        return
+        raise OrderError('Product does not exist.')
 
-    total_cost = product[0] * quantity
+    product_id, product_name, _, _ = product
 
-    if quantity > product[1]:
-        await update.callback_query.message.reply_text('Not enough product available on the market.')
-        conn.close()
-        return
+    # Take the quantity out of the holdings only if the user has enough of it
+    c.execute("UPDATE holdings SET quantity = quantity - ? WHERE user_id = ? AND product_id = ? AND quantity >= ?",
+              (quantity, user_id, product_id, quantity))
+    if c.rowcount == 0:
+        raise OrderError(f'Not enough {product_name} in portfolio to sell.')
+    c.execute("DELETE FROM holdings WHERE user_id = ? AND product_id = ? AND quantity = 0", (user_id, product_id))
 
-    c.execute("SELECT balance, portfolio FROM users WHERE id = ?", (user_id,))
-    user_data = c.fetchone()
+    c.execute("UPDATE market SET availability = availability + ? WHERE id = ? RETURNING current_price", (quantity, product_id))
+    price = c.fetchone()[0]
+    total_revenue = price * quantity
 
-    if user_data is None:
-        await update.callback_query.message.reply_text('User not found.')
-        conn.close()
+    # Update data
+    c.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (total_revenue, user_id))
+    c.execute("INSERT INTO transactions (user_id, type, product_id, amount, price, date) VALUES (?, 'sell', ?, ?, ?, datetime('now'))", (user_id, product_id, quantity, price))
+    post_entry(c, 'sell', [('user', user_id, LEDGER_CASH, total_revenue), ('market', None, LEDGER_CASH, -total_revenue),
+                           ('user', user_id, product_id, -quantity), ('market', None, product_id, quantity)])
+    return product_name, quantity, total_revenue
+
+# Function to execute a batch of (side, product_id, quantity) orders in one transaction, using an open cursor.
+# Either every order is applied or, if one raises OrderError, none of them is.
+# Returns the results and the user's profile after the orders, for the profile cache.
+def execute_orders(c, user_id, orders):
+    results = []
+    for side, product_id, quantity in orders:
+        execute = execute_buy if side == 'buy' else execute_sell
+        results.append((side,) + execute(c, user_id, product_id, quantity))
+    refresh_wealth(c, user_id)
+    market_cache.refresh(c, *{product_id for _, product_id, _ in orders})
+    return results, load_profile(c, user_id)
+
+ORDERS_FAILED_TEXT = "The market is busy right now and your order was not placed. Please try again."
+
+# Function to place orders for the user and reply with the outcome
+async def place_orders(update: Update, orders) -> None:
+    user_id = update.effective_user.id
+    message = update.message or update.callback_query.message
+    try:
+        results, profile = await db.group_commit(execute_orders, user_id, orders)
+    except OrderError as e:
+        await message.reply_text(str(e))
         return
-
-    balance = user_data[0]
-    portfolio = json.loads(user_data[1])
-
-    if balance < total_cost:
-        await update.callback_query.message.reply_text('Insufficient funds.')
-        conn.close()
+    except sqlite3.Error:
+        logger.exception("Orders of user %s failed", user_id)
+        await message.reply_text(ORDERS_FAILED_TEXT)
         return
+    user_cache.put(user_id, profile)
 
-    # Update data
-    c.execute("UPDATE users SET balance = balance - ? WHERE id = ?", (total_cost, user_id))
-    c.execute("UPDATE market SET availability = availability - ? WHERE id = ?", (quantity, product_id))
-
-    # Update portfolio
-    if str(product_id) in portfolio:
-        portfolio[str(product_id)] += quantity
-    else:
-        portfolio[str(product_id)] = quantity
-
-    c.execute("UPDATE users SET portfolio = ? WHERE id = ?", (json.dumps(portfolio), user_id))
-    c.execute("INSERT INTO transactions (user_id, type, product_id, amount, price, date) VALUES (?, 'buy', ?, ?, ?, datetime('now'))", (user_id, product_id, quantity, product[0]))
-    conn.commit()
-    conn.close()
-
-    keyboard = [[InlineKeyboardButton("Back to menu", callback_data='menu')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.callback_query.message.reply_text(f'You bought {quantity} units of the product for {total_cost}.', reply_markup=reply_markup)
+    lines = []
+    for side, product_name, quantity, total in results:
+        verb = 'bought' if side == 'buy' else 'sold'
+        lines.append(f'You {verb} {quantity} units of {product_name} for {total:.2f}.')
 
-# Function to handle product sale
-async def sell(update: Update, context: CallbackContext, product_id) -> None:
-    user_id = update.callback_query.from_user.id
-    quantity = 1  # Can be adjusted if we want to allow selling more than one unit at a time
+    await message.reply_text('\n'.join(lines), reply_markup=BACK_TO_MENU_KEYBOARD)
 
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT current_price FROM market WHERE id = ?", (product_id,))
-    product = c.fetchone()
-
-    if not product:
-        await update.callback_query.message.reply_text('Product does not exist.')
-        conn.close()
+# Function to handle product purchase
+async def buy(update: Update, context: CallbackContext, product_id, quantity=1) -> None:
+    try:
+        quantity = parse_quantity(quantity)
+    except OrderError as e:
+        await update.callback_query.message.reply_text(str(e))
         return
+    await place_orders(update, [('buy', product_id, quantity)])
 
-    c.execute("SELECT balance, portfolio FROM users WHERE id = ?", (user_id,))
-    user_data = c.fetchone()
-
-    if user_data is None:
-        await update.callback_query.message.reply_text('User not found.')
-        conn.close()
+# Function to handle product sale
+async def sell(update: Update, context: CallbackContext, product_id, quantity=1) -> None:
+    try:
+        quantity = parse_quantity(quantity)
+    except OrderError as e:
+        await update.callback_query.message.reply_text(str(e))
         return
-
-    balance = user_data[0]
-    portfolio = json.loads(user_data[1])
-
-    if str(product_id) not in portfolio or portfolio[str(product_id)] < quantity:
-        await update.callback_query.message.reply_text('Not enough product in portfolio to sell.')
-        conn.close()
+    await place_orders(update, [('sell', product_id, quantity)])
+
+# Function to parse "<product> <qty> [<product> <qty> ...]" command arguments into orders
+def parse_orders(side, args):
+    if not args or len(args) % 2:
+        raise OrderError(f'Usage: /{side} <product> <quantity> [<product> <quantity> ...]')
+    snapshot = market_cache.snapshot
+    orders = []
+    for name_or_id, quantity in zip(args[::2], args[1::2]):
+        product = snapshot.find(name_or_id)
+        if not product:
+            raise OrderError(f"Product '{name_or_id}' does not exist.")
+        orders.append((side, product[0], parse_quantity(quantity)))
+    return orders
+
+# Function to handle the /buy and /sell commands, e.g. /buy gold 2 silver 10
+async def order_command(update: Update, context: CallbackContext) -> None:
+    side = 'buy' if update.message.text.lstrip('/').lower().startswith('buy') else 'sell'
+    try:
+        orders = parse_orders(side, context.args)
+    except OrderError as e:
+        await update.message.reply_text(str(e))
         return
-
-    total_revenue = product[0] * quantity
-
-    # Update data
-    portfolio[str(product_id)] -= quantity
-    if portfolio[str(product_id)] == 0:
-        del portfolio[str(product_id)]
-
-    c.execute("UPDATE users SET balance = balance + ?, portfolio = ? WHERE id = ?", (total_revenue, json.dumps(portfolio), user_id))
-    c.execute("UPDATE market SET availability = availability + ? WHERE id = ?", (quantity, product_id))
-    c.execute("INSERT INTO transactions (user_id, type, product_id, amount, price, date) VALUES (?, 'sell', ?, ?, ?, datetime('now'))", (user_id, product_id, quantity, product[0]))
-    conn.commit()
-    conn.close()
-
-    keyboard = [[InlineKeyboardButton("Back to menu", callback_data='menu')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.callback_query.message.reply_text(f'You sold {quantity} units of the product for {total_revenue}.', reply_markup=reply_markup)
+    await place_orders(update, orders)
 
 # Function to display the user's portfolio
 async def portfolio(update: Update, context: CallbackContext) -> None:
     user_id = update.callback_query.from_user.id
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT portfolio FROM users WHERE id = ?", (user_id,))
-    portfolio = c.fetchone()[0]
-    portfolio = json.loads(portfolio)
+    profile = await user_profile(user_id)
+    holdings = profile.holdings if profile else ()
+    snapshot = market_cache.snapshot
+    portfolio = [(product_id, snapshot.by_id[product_id][1], quantity) for product_id, quantity in holdings]
     if not portfolio:
-        keyboard = [[InlineKeyboardButton("Back to menu", callback_data='menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.callback_query.message.reply_text('Your portfolio is empty.', reply_markup=reply_markup)
+        await show(update, 'Your portfolio is empty.', BACK_TO_MENU_KEYBOARD)
     else:
         portfolio_text = 'Your portfolio:\n'
         keyboard = []
-        for product_id, quantity in portfolio.items():
-            c.execute("SELECT name FROM market WHERE id = ?", (product_id,))
-            product_name = c.fetchone()[0]
+        for product_id, product_name, quantity in portfolio:
             portfolio_text += f'{product_name}: {quantity} units\n'
-            keyboard.append([InlineKeyboardButton(f'Sell {product_name}', callback_data=f'sell_{product_id}')])
-        keyboard.append([InlineKeyboardButton("Back to menu", callback_data='menu')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.callback_query.message.reply_text(portfolio_text, reply_markup=reply_markup)
-    conn.close()
+            row = [InlineKeyboardButton(f'Sell {product_name}', callback_data=f'sell_{product_id}')]
+            if quantity > 1:
+                row.append(InlineKeyboardButton('Sell all', callback_data=f'sell_{product_id}_{quantity}'))
+            keyboard.append(row)
+        keyboard.append(BACK_TO_MENU_ROW)
+        await show(update, portfolio_text, InlineKeyboardMarkup(keyboard))
+
+# Function to apply a boom or crash to one product, using an open cursor.
+# Returns the product name, or None if the product does not exist.
+def apply_price_event(c, product_id, event_type):
+    product = market_cache.snapshot.get(product_id)
+    if not product:
+        return None
+    product_id, product_name, _, _ = product
+    factor = 1.2 if event_type == 'boom' else 0.8
+    c.execute("UPDATE market SET current_price = ROUND(current_price * ?, 2) WHERE id = ? RETURNING current_price", (factor, product_id))
+    price = c.fetchone()[0]
+    reprice_holders(c, product_id)
+    market_cache.refresh(c, product_id)
+    record_prices(c, [(product_id, price)])
+    return product_name
+
+# OHLC resolutions in seconds, with their /history labels
+PRICE_RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+# Retention in seconds: raw ticks and short bars are dropped once longer bars cover them (None keeps forever)
+PRICE_TICK_RETENTION = 86400
+PRICE_OHLC_RETENTION = {60: 7 * 86400, 3600: 90 * 86400, 86400: None}
+HISTORY_BARS = 12
+
+# Function to append price changes to the history and roll them into the OHLC bars, using an open cursor
+def record_prices(c, prices, ts=None):
+    ts = int(ts if ts is not None else time.time())
+    prices = [(product_id, price) for product_id, price in prices]
+    c.executemany("INSERT OR REPLACE INTO price_ticks (product_id, ts, price) VALUES (?, ?, ?)",
+                  [(product_id, ts, price) for product_id, price in prices])
+    c.executemany("""INSERT INTO price_ohlc (product_id, resolution, bucket, open, high, low, close) VALUES (?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT (product_id, resolution, bucket) DO UPDATE SET
+                         high = max(high, excluded.high), low = min(low, excluded.low), close = excluded.close""",
+                  [(product_id, resolution, ts - ts % resolution, price, price, price, price)
+                   for product_id, price in prices for resolution in PRICE_RESOLUTIONS.values()])
+
+# Function to apply the price history retention policy, using an open cursor
+def prune_price_history(c, now=None):
+    now = int(now if now is not None else time.time())
+    c.execute("DELETE FROM price_ticks WHERE ts < ?", (now - PRICE_TICK_RETENTION,))
+    for resolution, retention in PRICE_OHLC_RETENTION.items():
+        if retention is not None:
+            c.execute("DELETE FROM price_ohlc WHERE resolution = ? AND bucket < ?", (resolution, now - retention))
+
+# Function to run price history maintenance, an hourly job
+async def price_history_maintenance():
+    await db.transaction(prune_price_history)
+
+# Function to handle the /history command showing the latest OHLC bars of a product
+async def history(update: Update, context: CallbackContext) -> None:
+    if not context.args:
+        await update.message.reply_text("Usage: /history <product> [1m|1h|1d]")
+        return
 
-# Function to generate random economic events
-async def generate_economic_event(application):
-    while True:
-        await asyncio.sleep(random.randint(10, 60))  # Random delay between 1 minute and 3 hours
-        event_type = random.choice(['boom', 'crash'])
-        product_id = random.choice([1, 2, 3, 4, 5, 6])  # Product ID
+    product = market_cache.snapshot.find(context.args[0])
+    if not product:
+        await update.message.reply_text(f"Product '{context.args[0]}' does not exist.")
+        return
 
-        conn = sqlite3.connect('game.db')
-        c = conn.cursor()
-        c.execute("SELECT name, current_price FROM market WHERE id = ?", (product_id,))
-        product = c.fetchone()
-        if product:
-            product_name, current_price = product
-            if event_type == 'boom':
-                new_price = round(current_price * 1.2, 2)
-                message_text = f'Sudden demand increase for {product_name}! Prices are rising.'
-            elif event_type == 'crash':
-                new_price = round(current_price * 0.8, 2)
-                message_text = f'Demand drop for {product_name}! Prices are falling.'
-
-            c.execute("UPDATE market SET current_price = ? WHERE id = ?", (new_price, product_id))
-            conn.commit()
-            conn.close()
+    label = context.args[1] if len(context.args) > 1 else '1h'
+    if label not in PRICE_RESOLUTIONS:
+        await update.message.reply_text("Resolution must be one of: " + ', '.join(PRICE_RESOLUTIONS))
+        return
 
-            # Send message to all users
-            users = get_all_users()
-            keyboard = [[InlineKeyboardButton("Back to menu", callback_data='menu')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            for user_id in users:
-                try:
-                    await application.bot.send_message(chat_id=user_id, text=message_text, reply_markup=reply_markup)
-                except telegram.error.Forbidden:
-                    # User has blocked the bot
-                    continue
-                except telegram.error.BadRequest as e:
-                    if "Chat not found" in str(e):
-                        # Chat not found, possibly the user removed or blocked the bot
-                        continue
+    bars = await db.fetchall("SELECT bucket, open, high, low, close FROM price_ohlc WHERE product_id = ? AND resolution = ? ORDER BY bucket DESC LIMIT ?",
+                             (product[0], PRICE_RESOLUTIONS[label], HISTORY_BARS))
+    if not bars:
+        await update.message.reply_text(f"No price history for {product[1]} yet.")
+        return
+
+    history_text = f"{product[1]} price history ({label}):\n"
+    for bucket, open_, high, low, close in reversed(bars):
+        history_text += f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(bucket))}  O {open_:.2f}  H {high:.2f}  L {low:.2f}  C {close:.2f}\n"
+
+    await update.message.reply_text(history_text, reply_markup=BACK_TO_MENU_KEYBOARD)
+
+WEALTH_SNAPSHOT_INTERVAL = 3600
+WEALTH_HISTORY_RETENTION = 90 * 86400
+CHART_POINTS = 168  # One week of hourly snapshots or bars
+CHART_CACHE_BYTES = 16 * 1024 * 1024
+
+# Bumped after every wealth snapshot pass, so cached wealth charts of this shard are recognised as stale
+# without reading the table again
+wealth_history_version = 0
+
+# Function to record the wealth of every user of this shard in one pass, using an open cursor
+def snapshot_wealth(c, now=None):
+    now = int(now if now is not None else time.time())
+    bucket = now - now % WEALTH_SNAPSHOT_INTERVAL
+    c.execute("INSERT OR REPLACE INTO wealth_history (user_id, bucket, wealth) SELECT id, ?, wealth FROM users", (bucket,))
+    c.execute("DELETE FROM wealth_history WHERE bucket < ?", (now - WEALTH_HISTORY_RETENTION,))
+
+# Function to take the wealth snapshots, a job run every WEALTH_SNAPSHOT_INTERVAL seconds
+async def wealth_snapshots():
+    global wealth_history_version
+    await db.local_transaction(snapshot_wealth)
+    wealth_history_version += 1
+
+# Rendered charts by key, least recently used first, bounded by the total size of the PNGs.
+# Keys carry the version of the data a chart was drawn from, so a chart is rendered once per data change.
+class ChartCache:
+    def __init__(self, max_bytes=CHART_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._charts = collections.OrderedDict()
+
+    def get(self, key):
+        png = self._charts.get(key)
+        if png is not None:
+            self._charts.move_to_end(key)
+        metrics.inc('bot_chart_cache_total', (('result', 'hit' if png is not None else 'miss'),))
+        return png
+
+    def put(self, key, png):
+        if key in self._charts:
+            self.size -= len(self._charts.pop(key))
+        self._charts[key] = png
+        self.size += len(png)
+        while self.size > self.max_bytes and len(self._charts) > 1:
+            self.size -= len(self._charts.popitem(last=False)[1])
+        metrics.set('bot_chart_cache_bytes', self.size)
+
+chart_cache = ChartCache()
+
+# Function to draw a line chart of [(ts, value), ...] to PNG bytes; blocking, so run it on a separate thread
+def render_chart(title, points, ylabel):
+    # Imported here so the bot starts without matplotlib; the object API avoids pyplot's global state
+    from matplotlib.figure import Figure
+    import datetime
+
+    figure = Figure(figsize=(8, 4), dpi=100)
+    axes = figure.subplots()
+    axes.plot([datetime.datetime.fromtimestamp(ts, datetime.timezone.utc) for ts, _ in points], [value for _, value in points])
+    axes.set_title(title)
+    axes.set_ylabel(ylabel)
+    axes.grid(True, alpha=0.3)
+    figure.autofmt_xdate()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+# Function to handle the /chart [product] command: the user's wealth, or the hourly closes of a product
+async def chart(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    if context.args:
+        product = market_cache.snapshot.find(context.args[0])
+        if not product:
+            await update.message.reply_text(f"Product '{context.args[0]}' does not exist.")
+            return
+        # Prices only change through record_prices(), which also sets the close of the current hourly bar,
+        # so the current bucket and price identify the chart's data; trades leave it cached
+        now = int(time.time())
+        key = ('price', product[0], now - now % 3600, product[2])
+        title, ylabel = f"{product[1]} price", "Price"
+        query = ("SELECT bucket, close FROM price_ohlc WHERE product_id = ? AND resolution = 3600 ORDER BY bucket DESC LIMIT ?",
+                 (product[0], CHART_POINTS))
+    else:
+        key = ('wealth', user_id, wealth_history_version)
+        title, ylabel = "Your wealth", "Units"
+        query = ("SELECT bucket, wealth FROM wealth_history WHERE user_id = ? ORDER BY bucket DESC LIMIT ?", (user_id, CHART_POINTS))
+
+    png = chart_cache.get(key)
+    if png is None:
+        points = (await db.fetchall(*query))[::-1]
+        if len(points) < 2:
+            await update.message.reply_text("Not enough history for a chart yet.", reply_markup=BACK_TO_MENU_KEYBOARD)
+            return
+        try:
+            png = await asyncio.get_running_loop().run_in_executor(None, render_chart, title, points, ylabel)
+        except ImportError:
+            await update.message.reply_text("Charts are not available right now.")
+            return
+        chart_cache.put(key, png)
+
+    await update.message.reply_photo(photo=InputFile(png, filename='chart.png'), reply_markup=BACK_TO_MENU_KEYBOARD)
+
+TRADES_PAGE_SIZE = 10
+TRADE_ARCHIVE_AFTER_DAYS = 30
+TRADE_ARCHIVE_BATCH = 5000
+
+# Function to fetch one page of a user's trades older than before_id, newest first, using an open cursor.
+# The hot table is read first, then the monthly archives from newest to oldest until the page is full.
+def fetch_trades(c, user_id, before_id, limit=TRADES_PAGE_SIZE):
+    c.execute("SELECT name FROM transaction_archives ORDER BY month DESC")
+    tables = ['transactions'] + [row[0] for row in c.fetchall()]
+    trades = []
+    for table in tables:
+        c.execute(f"SELECT id, type, product_id, amount, price, date FROM {table} WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                  (user_id, before_id, limit - len(trades)))
+        trades += c.fetchall()
+        if len(trades) >= limit:
+            break
+    return trades
+
+# Function to handle the /history_trades command and its "Older" button
+async def history_trades(update: Update, context: CallbackContext, before_id=None) -> None:
+    user_id = update.effective_user.id
+    before_id = int(before_id) if before_id is not None else 2 ** 63 - 1
+    trades = await db.read(fetch_trades, user_id, before_id, TRADES_PAGE_SIZE + 1)
+    has_more = len(trades) > TRADES_PAGE_SIZE
+    trades = trades[:TRADES_PAGE_SIZE]
+
+    if not trades:
+        await show(update, "You have no trades yet.")
+        return
+
+    snapshot = market_cache.snapshot
+    history_text = "Your trades:\n"
+    for trade_id, trade_type, product_id, amount, price, date in trades:
+        product = snapshot.get(product_id)
+        history_text += f"{date}  {trade_type} {amount} x {product[1] if product else product_id} @ {price:.2f}\n"
+
+    keyboard = []
+    if has_more:
+        keyboard.append([InlineKeyboardButton("Older >", callback_data=f'trades_{trades[-1][0]}')])
+    keyboard.append(BACK_TO_MENU_ROW)
+    await show(update, history_text, InlineKeyboardMarkup(keyboard))
+
+# Function to move one batch of old trades into their monthly archive table, using an open cursor.
+# Returns the number of archived rows. Ids grow with dates, so a batch is always a prefix of the table.
+def archive_transactions_batch(c, cutoff):
+    c.execute("SELECT id, date FROM transactions ORDER BY id LIMIT 1")
+    oldest = c.fetchone()
+    if not oldest or oldest[1] >= cutoff:
+        return 0
+
+    # Stay within the oldest row's month, and before the cutoff
+    year, month = int(oldest[1][:4]), int(oldest[1][5:7])
+    month_end = f"{year + month // 12:04d}-{month % 12 + 1:02d}-01 00:00:00"
+    bound = min(cutoff, month_end)
+    c.execute("SELECT MAX(id) FROM (SELECT id, date FROM transactions ORDER BY id LIMIT ?) WHERE date < ?",
+              (TRADE_ARCHIVE_BATCH, bound))
+    last_id = c.fetchone()[0]
+    if last_id is None:
+        return 0
+
+    table = f"transactions_{year:04d}_{month:02d}"
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    type TEXT,
+                    product_id INTEGER,
+                    amount INTEGER,
+                    price REAL,
+                    date TEXT
+                )''')
+    c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user ON {table} (user_id, id)")
+    c.execute("INSERT OR IGNORE INTO transaction_archives (name, month) VALUES (?, ?)", (table, f"{year:04d}-{month:02d}"))
+    c.execute(f"INSERT INTO {table} SELECT id, user_id, type, product_id, amount, price, date FROM transactions WHERE id <= ?", (last_id,))
+    c.execute("DELETE FROM transactions WHERE id <= ?", (last_id,))
+    return c.rowcount
+
+# Function to archive all trades older than the given number of days, one short transaction per batch
+async def archive_transactions(days=TRADE_ARCHIVE_AFTER_DAYS):
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 86400))
+    archived = 0
+    while True:
+        count = await db.local_transaction(archive_transactions_batch, cutoff)
+        if not count:
+            break
+        archived += count
+    if archived:
+        logger.info("Archived %d trades older than %s", archived, cutoff)
+    return archived
+
+# Online backups: snapshots are copied with SQLite's backup API in small page batches, so
+# handlers keep reading and writing while a snapshot is taken, and are kept by age
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', 3600))  # Seconds between scheduled snapshots, 0 disables them
+BACKUP_PAGES = 256  # Pages copied per step
+BACKUP_STEP_SLEEP = 0.005  # Seconds between steps, leaving the database to the handlers
+BACKUP_MAX_RESTARTS = 3  # Restarts caused by concurrent writes before copying in one step
+BACKUP_KEEP_RECENT = 24  # Newest snapshots always kept
+BACKUP_KEEP_DAYS = 7  # Beyond those, the newest snapshot of each of the last days is kept
+
+class BackupRestarted(Exception):
+    pass
+
+# Function to copy a whole database between two connections.
+# Every write by another connection restarts a batched copy, so under constant trading the copy
+# falls back to a single step, which in WAL mode only holds a read snapshot and blocks no writer.
+def copy_database(source, target, pages=BACKUP_PAGES, sleep=BACKUP_STEP_SLEEP):
+    progress = {'remaining': None, 'restarts': 0}
+
+    def on_progress(status, remaining, total):
+        if progress['remaining'] is not None and remaining > progress['remaining']:
+            progress['restarts'] += 1
+            if progress['restarts'] > BACKUP_MAX_RESTARTS:
+                raise BackupRestarted()
+        progress['remaining'] = remaining
+
+    try:
+        source.backup(target, pages=pages, progress=on_progress, sleep=sleep)
+    except BackupRestarted:
+        source.backup(target)
+
+# Takes and prunes the snapshots of one database file, named <name>-<UTC timestamp>.db
+class BackupManager:
+    def __init__(self, path, directory=BACKUP_DIR):
+        self.path = path
+        self.directory = directory
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self._conn = None
+        self._data_version = None
+
+    # Takes a snapshot unless nothing was committed since the last one. Returns its path, or None when skipped.
+    def snapshot(self, force=False, now=None):
+        now = time.time() if now is None else now
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        # data_version changes whenever another connection commits to the file
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if not force and data_version == self._data_version:
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime(now))}.db")
+        partial = path + '.part'
+        target = sqlite3.connect(partial)
+        try:
+            copy_database(self._conn, target)
+            # The snapshot is a single self-contained file
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+        os.replace(partial, path)
+        self._data_version = data_version
+        self.prune(now)
+        return path
+
+    # Returns [(timestamp, path), ...] of this database's snapshots, newest first
+    def snapshots(self):
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for filename in os.listdir(self.directory):
+            stem, ext = os.path.splitext(filename)
+            name, _, stamp = stem.rpartition('-')
+            name, _, day = name.rpartition('-')
+            if ext != '.db' or name != self.name:
+                continue
+            try:
+                ts = calendar.timegm(time.strptime(f"{day}-{stamp}", '%Y%m%d-%H%M%S'))
+            except ValueError:
+                continue
+            found.append((ts, os.path.join(self.directory, filename)))
+        return sorted(found, reverse=True)
+
+    # Deletes snapshots beyond the newest BACKUP_KEEP_RECENT, except the newest one per day for BACKUP_KEEP_DAYS
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        kept_days = set()
+        for i, (ts, path) in enumerate(self.snapshots()):
+            day = int(ts // 86400)
+            if i < BACKUP_KEEP_RECENT or (day not in kept_days and now - ts < BACKUP_KEEP_DAYS * 86400):
+                kept_days.add(day)
+                continue
+            os.remove(path)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+# Function to return the backup managers of the files this worker is responsible for
+def backup_managers():
+    global _backup_managers
+    if _backup_managers is None:
+        _backup_managers = [BackupManager(db.path)]
+        if SHARDED and WORKER_INDEX == 0:
+            _backup_managers.append(BackupManager(SHARED_DB_PATH))
+    return _backup_managers
+
+_backup_managers = None
+
+# Function to snapshot this worker's databases off the event loop. Returns the paths of new snapshots.
+async def take_backups(force=False):
+    loop = asyncio.get_running_loop()
+    paths = []
+    for manager in backup_managers():
+        path = await loop.run_in_executor(None, manager.snapshot, force)
+        if path:
+            paths.append(path)
+    return paths
+
+# Function to take the scheduled snapshots, a job run every BACKUP_INTERVAL seconds
+async def scheduled_backups():
+    for path in await take_backups():
+        logger.info("Backup written to %s", path)
+
+# Function to handle the admin /backup command, taking a snapshot right away
+async def backup(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    paths = await take_backups(force=True)
+    await update.message.reply_text("Backup written to:\n" + '\n'.join(paths))
+
+# Function to restore a database file from a snapshot; the bot must not be running.
+# The snapshot is checked first and copied in a single step.
+def restore_backup(snapshot, target=None):
+    target = target or db.path
+    source = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True)
+    try:
+        result = source.execute("PRAGMA quick_check").fetchone()[0]
+        if result != 'ok':
+            raise ValueError(f"Snapshot {snapshot} is damaged: {result}")
+        destination = sqlite3.connect(target)
+        try:
+            source.backup(destination)
+            # Snapshots are stored in rollback-journal mode; the live file runs in WAL
+            destination.execute("PRAGMA journal_mode = WAL")
+        finally:
+            destination.close()
+    finally:
+        source.close()
+
+LEDGER_REPLAY_BATCH = 10000
+
+# Function to rebuild balances and holdings from the ledger in one streaming pass, using an open cursor.
+# Returns ({user_id: balance}, {(user_id, product_id): quantity}, [(entry, asset, imbalance), ...], rows read).
+# Postings of an entry are contiguous by id, so entries are checked to balance as they stream past.
+def replay_ledger(c):
+    balances = collections.defaultdict(float)
+    holdings = collections.defaultdict(int)
+    unbalanced = []
+    entry_sums = {}
+    current_entry = None
+    rows = 0
+
+    def close_entry():
+        unbalanced.extend((current_entry, asset, total) for asset, total in entry_sums.items() if abs(total) > LEDGER_TOLERANCE)
+        entry_sums.clear()
+
+    c.execute("SELECT entry, account, user_id, asset, amount FROM ledger ORDER BY id")
+    for batch in iter(lambda: c.fetchmany(LEDGER_REPLAY_BATCH), []):
+        rows += len(batch)
+        for entry, account, user_id, asset, amount in batch:
+            if entry != current_entry:
+                close_entry()
+                current_entry = entry
+            entry_sums[asset] = entry_sums.get(asset, 0.0) + amount
+            if account == 'user':
+                if asset == LEDGER_CASH:
+                    balances[user_id] += amount
+                else:
+                    holdings[(user_id, asset)] += int(amount)
+    close_entry()
+    return balances, holdings, unbalanced, rows
+
+# Function to diff a replayed state against the live tables, using an open cursor.
+# Returns [(user_id, asset, ledger_amount, live_amount), ...] for every balance or holding that drifted.
+def check_ledger(c, balances, holdings):
+    drift = []
+    balances = dict(balances)
+    holdings = dict(holdings)
+    c.execute("SELECT id, balance FROM users")
+    for batch in iter(lambda: c.fetchmany(LEDGER_REPLAY_BATCH), []):
+        for user_id, balance in batch:
+            expected = balances.pop(user_id, 0.0)
+            if abs(expected - balance) > LEDGER_TOLERANCE:
+                drift.append((user_id, LEDGER_CASH, expected, balance))
+    c.execute("SELECT user_id, product_id, quantity FROM holdings")
+    for batch in iter(lambda: c.fetchmany(LEDGER_REPLAY_BATCH), []):
+        for user_id, product_id, quantity in batch:
+            expected = holdings.pop((user_id, product_id), 0)
+            if expected != quantity:
+                drift.append((user_id, product_id, expected, quantity))
+    # Whatever the live tables did not account for is drift too, unless it nets to nothing
+    drift += [(user_id, LEDGER_CASH, amount, None) for user_id, amount in balances.items() if abs(amount) > LEDGER_TOLERANCE]
+    drift += [(user_id, product_id, quantity, 0) for (user_id, product_id), quantity in holdings.items() if quantity]
+    return drift
+
+# Function to overwrite live balances and holdings with a replayed state, using an open cursor.
+# Users without ledger postings are left alone; wealth and company values are recomputed afterwards.
+def apply_replay(c, balances, holdings):
+    c.executemany("UPDATE users SET balance = ? WHERE id = ?", [(round(balance, 2), user_id) for user_id, balance in balances.items()])
+    c.execute("DELETE FROM holdings")
+    c.executemany("INSERT INTO holdings (user_id, product_id, quantity) VALUES (?, ?, ?)",
+                  [(user_id, product_id, quantity) for (user_id, product_id), quantity in holdings.items() if quantity])
+    c.execute(f"UPDATE users SET wealth = {WEALTH_SQL} RETURNING id, wealth - balance")
+    revalue_companies(c, c.fetchall())
+
+# Function to apply a boom or crash to a product and notify users about it
+async def run_market_event(product_id, event_type):
+    product_name = await db.transaction(apply_price_event, product_id, event_type)
+    if product_name:
+        if event_type == 'boom':
+            message_text = f'Sudden demand increase for {product_name}! Prices are rising.'
+        elif event_type == 'crash':
+            message_text = f'Demand drop for {product_name}! Prices are falling.'
+
+        # Notify users according to their preferences, the broadcasters deliver it in the background
+        await publish_event(message_text, product_id)
+
+# Function to generate a random economic event, a job rescheduled after a random delay
+async def generate_economic_event():
+    event_type = random.choice(['boom', 'crash'])
+    product_id = random.choice([1, 2, 3, 4, 5, 6])  # Product ID
+    await run_market_event(product_id, event_type)
+
+# Function to run a market event scheduled with /schedule_event
+async def scheduled_market_event(payload):
+    await run_market_event(payload['product_id'], payload['event_type'])
+
+# Continuous market simulation, enabled with MARKET_MODEL=gbm|mean_reversion (requires NumPy).
+# Without it the market only moves through the economic_event job.
+MARKET_MODEL = os.environ.get('MARKET_MODEL')
+MARKET_SEED = int(os.environ['MARKET_SEED']) if os.environ.get('MARKET_SEED') else None
+MARKET_INSTRUMENTS = int(os.environ.get('MARKET_INSTRUMENTS', 0))  # Generated instruments added on top of the base products
+SIMULATION_TICK = 5.0  # Seconds between ticks
+SIMULATION_PARAMS = {
+    'drift': 0.0,  # Annualised drift of the GBM model
+    'volatility': 0.6,  # Annualised volatility
+    'reversion': 5.0,  # Speed of mean reversion towards each instrument's starting price
+    'correlation': 0.3,  # Share of every shock coming from the common market factor
+    'regime_probability': 0.0005,  # Chance per tick of a market-wide hossa or bessa
+}
+GENERATED_INSTRUMENT_BASE_ID = 1000
+
+# Vectorized price model advancing every instrument in one NumPy step per tick.
+# Shocks are correlated through a single common market factor (or a full correlation matrix),
+# so a tick costs O(instruments) for any number of instruments.
+class MarketSimulator:
+    def __init__(self, product_ids, prices, model='gbm', seed=None, dt=SIMULATION_TICK / (365 * 86400),
+                 drift=0.0, volatility=0.6, reversion=5.0, correlation=0.3, correlation_matrix=None,
+                 regime_probability=0.0):
+        import numpy as np  # Imported here so the bot starts without NumPy when the simulation is off
+
+        if model not in ('gbm', 'mean_reversion'):
+            raise ValueError(f"Unknown market model: {model}")
+        self.np = np
+        self.model = model
+        self.rng = np.random.default_rng(seed)
+        self.product_ids = list(product_ids)
+        self.log_prices = np.log(np.asarray(prices, dtype=float))
+        self.log_means = self.log_prices.copy()
+        self.dt = dt
+        self.drift = drift
+        self.volatility = np.broadcast_to(np.asarray(volatility, dtype=float), self.log_prices.shape)
+        self.reversion = reversion
+        self.correlation = correlation
+        self.cholesky = np.linalg.cholesky(np.asarray(correlation_matrix, dtype=float)) if correlation_matrix is not None else None
+        self.regime_probability = regime_probability
+
+    @property
+    def prices(self):
+        return self.np.maximum(self.np.round(self.np.exp(self.log_prices), 2), 0.01)
+
+    def _shocks(self):
+        np = self.np
+        n = len(self.product_ids)
+        if self.cholesky is not None:
+            return self.cholesky @ self.rng.standard_normal(n)
+        common = self.rng.standard_normal()
+        return np.sqrt(self.correlation) * common + np.sqrt(1 - self.correlation) * self.rng.standard_normal(n)
+
+    # Advances all prices by one tick. Returns (prices, regime) where regime is None or ('hossa'|'bessa', factor).
+    def step(self):
+        np = self.np
+        diffusion = self.volatility * np.sqrt(self.dt) * self._shocks()
+        if self.model == 'gbm':
+            self.log_prices += (self.drift - self.volatility ** 2 / 2) * self.dt + diffusion
+        else:
+            self.log_prices += self.reversion * (self.log_means - self.log_prices) * self.dt + diffusion
+
+        regime = None
+        if self.regime_probability and self.rng.random() < self.regime_probability:
+            # Market-wide regimes from the original hossa/bessa events
+            if self.rng.random() < 0.5:
+                regime = ('hossa', float(self.rng.uniform(1.5, 12.0)))
+            else:
+                regime = ('bessa', float(self.rng.uniform(0.1, 0.5)))
+            self.log_prices += np.log(regime[1])
+            self.log_means += np.log(regime[1])
+        return self.prices, regime
+
+    # Takes over prices changed outside the simulation, e.g. by economic events, so the next step starts from them.
+    # Prices still equal to what the simulator last produced keep their unrounded state.
+    def set_prices(self, prices):
+        prices = self.np.asarray(prices, dtype=float)
+        changed = self.np.abs(prices - self.prices) > 0.005
+        self.log_prices[changed] = self.np.log(prices[changed])
+
+# Function to add generated instruments until the market has `count` of them beyond the base products, using an open cursor
+def seed_instruments(c, count, seed=None):
+    rng = random.Random(seed)
+    c.execute("SELECT COUNT(*) FROM market WHERE id >= ?", (GENERATED_INSTRUMENT_BASE_ID,))
+    existing = c.fetchone()[0]
+    instruments = [(GENERATED_INSTRUMENT_BASE_ID + i, f"Asset {i + 1}", round(rng.uniform(1.0, 2000.0), 2), rng.randint(100, 10000))
+                   for i in range(existing, count)]
+    c.executemany("INSERT OR IGNORE INTO market (id, name, current_price, availability, supply) VALUES (?, ?, ?, ?, ?)",
+                  [instrument + (instrument[3],) for instrument in instruments])
+    c.executemany("INSERT OR IGNORE INTO price_ticks (product_id, ts, price) VALUES (?, ?, ?)",
+                  [(product_id, int(time.time()), price) for product_id, _, price, _ in instruments])
+
+# Function to advance the simulation by one tick and write it, using an open cursor. Returns the regime, if any.
+# The step starts from the prices in the market, so it builds on economic events instead of overwriting them.
+# All prices go to the market in a single UPDATE ... FROM over a JSON array of [id, price] pairs.
+def apply_simulation_tick(c, simulator):
+    c.execute("SELECT id, current_price FROM market")
+    current = dict(c.fetchall())
+    simulator.set_prices([current[product_id] for product_id in simulator.product_ids])
+    prices, regime = simulator.step()
+    pairs = [[int(product_id), float(price)] for product_id, price in zip(simulator.product_ids, prices)]
+    c.execute("""UPDATE market SET current_price = json_extract(t.value, '$[1]')
+                 FROM json_each(?) t WHERE market.id = json_extract(t.value, '$[0]')""", (json.dumps(pairs),))
+    c.execute(f"UPDATE users SET wealth = {WEALTH_SQL} WHERE id IN (SELECT DISTINCT user_id FROM holdings) RETURNING id, wealth, wealth - balance")
+    rows = c.fetchall()
+    after_commit(leaderboard.update_many, [(user_id, wealth) for user_id, wealth, _ in rows])
+    revalue_companies(c, [(user_id, holdings_value) for user_id, _, holdings_value in rows])
+    after_commit(repriced_prices.update, pairs)
+    market_cache.refresh(c)
+    record_prices(c, pairs)
+    return regime
+
+# Function to build the simulator from the current market snapshot
+def create_market_simulator(model=MARKET_MODEL, seed=MARKET_SEED, **params):
+    products = market_cache.snapshot.products
+    return MarketSimulator([product[0] for product in products], [product[2] for product in products],
+                           model=model, seed=seed, **{**SIMULATION_PARAMS, **params})
+
+# Function to advance the market simulation by one tick, a job run every SIMULATION_TICK seconds
+async def run_market_simulation(simulator):
+    regime = await db.transaction(apply_simulation_tick, simulator)
+
+    if regime:
+        event_type, factor = regime
+        if event_type == 'hossa':
+            message_text = f"Hossa! Prices of all products have increased by {(factor * 100):.2f}%!"
+        else:
+            message_text = f"Bessa! Prices of all products have dropped by {((1 - factor) * 100):.2f}%!"
+        await publish_event(message_text)
 
 
 
@@ -538,48 +2343,314 @@ async def generate_economic_event(application):
 
 
 
-def get_all_users():
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-    c.execute("SELECT id FROM users")
-    users = [row[0] for row in c.fetchall()]
-    conn.close()
-    return users
-
-
+# Notification preferences: every event as it happens, a digest every digest_minutes,
+# only events for products the user holds, or nothing
+NOTIFY_MODES = ('instant', 'digest', 'holdings', 'off')
+DIGEST_DEFAULT_MINUTES = 60
+DIGEST_MIN_MINUTES = 5
+DIGEST_MAX_MINUTES = 1440  # Also how long market events are kept
+DIGEST_CHECK_INTERVAL = 60
+DIGEST_MAX_EVENTS = 20  # Events listed in one digest, older ones are summarized as a count
+
+# Users to notify right away about an event; product_id is None for market-wide events
+INSTANT_RECIPIENTS_SQL = """SELECT id FROM users WHERE blocked = 0 AND (notify_mode = 'instant'
+                                OR (notify_mode = 'holdings' AND id IN (SELECT user_id FROM holdings WHERE ? IS NULL OR product_id = ?)))"""
+
+# Function to record a market event and queue it for the users who want it immediately.
+# Digest subscribers receive it with their next digest; each shard's outbox is drained by the worker owning it.
+async def publish_event(text, product_id=None):
+    await db.transaction(lambda c: c.execute("INSERT INTO market_events (ts, product_id, text) VALUES (?, ?, ?)",
+                                             (time.time(), product_id, text)))
+    for database in all_databases():
+        users = [row[0] for row in await database.fetchall(INSTANT_RECIPIENTS_SQL, (product_id, product_id))]
+        await broadcaster.enqueue(users, text, BACK_TO_MENU_KEYBOARD, database=database)
+
+# Function to format the events of one digest window as a single message
+def format_digest(events):
+    lines = [f"Market digest ({len(events)} events):"]
+    lines += [f"• {text}" for text in events[-DIGEST_MAX_EVENTS:]]
+    if len(events) > DIGEST_MAX_EVENTS:
+        lines.insert(1, f"• ...and {len(events) - DIGEST_MAX_EVENTS} earlier events")
+    return '\n'.join(lines)
+
+# Function to queue the digests of every subscriber whose window has ended, using an open cursor.
+# Users who last got a digest at the same moment share one window, so each window is built once.
+# Returns the number of queued messages.
+def collect_digests(c, now):
+    c.execute("""SELECT id, last_digest_at FROM users
+                 WHERE notify_mode = 'digest' AND blocked = 0 AND last_digest_at <= ? - digest_minutes * 60""", (now,))
+    due = c.fetchall()
+    windows = {}
+    for user_id, since in due:
+        windows.setdefault(since, []).append(user_id)
+
+    queued = 0
+    for since, user_ids in windows.items():
+        c.execute("SELECT text FROM market_events WHERE ts > ? AND ts <= ? ORDER BY ts", (since, now))
+        events = [row[0] for row in c.fetchall()]
+        if events:
+            queue_messages(c, user_ids, format_digest(events), BACK_TO_MENU_KEYBOARD)
+            queued += len(user_ids)
+    c.executemany("UPDATE users SET last_digest_at = ? WHERE id = ?", [(now, user_id) for user_id, _ in due])
+    return queued
+
+# Function to send due digests from this worker's shard, and drop events no digest can still include.
+# A job run every DIGEST_CHECK_INTERVAL seconds.
+async def send_digests():
+    now = time.time()
+    if await db.local_transaction(collect_digests, now):
+        broadcaster.wake()
+    if WORKER_INDEX == 0:
+        await db.execute("DELETE FROM market_events WHERE ts < ?", (now - DIGEST_MAX_MINUTES * 60,))
+
+NOTIFY_DESCRIPTIONS = {
+    'instant': "every market event as it happens",
+    'digest': "a digest of market events every {minutes} minutes",
+    'holdings': "events for products you hold, as they happen",
+    'off': "no market events",
+}
+NOTIFY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Instant", callback_data='notify_instant'), InlineKeyboardButton("Digest", callback_data='notify_digest')],
+    [InlineKeyboardButton("Only my products", callback_data='notify_holdings'), InlineKeyboardButton("Off", callback_data='notify_off')],
+    BACK_TO_MENU_ROW,
+])
+
+# Function to store the user's notification preference, using an open cursor.
+# A new digest window starts now, so switching to digests never replays old events.
+def execute_set_notifications(c, user_id, mode, minutes=None):
+    c.execute("UPDATE users SET notify_mode = ?, digest_minutes = COALESCE(?, digest_minutes), last_digest_at = ? WHERE id = ?",
+              (mode, minutes, time.time(), user_id))
+
+# Function to handle /notifications [instant|digest [minutes]|holdings|off] and the preference buttons
+async def notifications(update: Update, context: CallbackContext, mode=None) -> None:
+    user_id = update.effective_user.id
+    minutes = None
+    if mode is None and context.args:
+        mode = context.args[0].lower()
+        if mode == 'digest' and len(context.args) > 1:
+            try:
+                minutes = int(context.args[1])
+            except ValueError:
+                minutes = 0
+            if not DIGEST_MIN_MINUTES <= minutes <= DIGEST_MAX_MINUTES:
+                await update.message.reply_text(f"Digest interval must be between {DIGEST_MIN_MINUTES} and {DIGEST_MAX_MINUTES} minutes.")
+                return
+    if mode is not None:
+        if mode not in NOTIFY_MODES:
+            await update.message.reply_text("Usage: /notifications [instant|digest <minutes>|holdings|off]")
+            return
+        await db.local_transaction(execute_set_notifications, user_id, mode, minutes)
+
+    row = await db.fetchone("SELECT notify_mode, digest_minutes FROM users WHERE id = ?", (user_id,))
+    if not row:
+        await show(update, "Use /start to join the game first.")
+        return
+    notify_mode, digest_minutes = row
+    text = (f"You receive {NOTIFY_DESCRIPTIONS[notify_mode].format(minutes=digest_minutes)}.\n\n"
+            "Choose below, or use /notifications digest <minutes> to set the digest interval.")
+    await show(update, text, NOTIFY_KEYBOARD)
+
+
+# Broadcast configuration, kept below Telegram's limits of ~30 messages/s overall and 1 message/s per chat
+BROADCAST_RATE = 25  # Messages per second across all chats
+BROADCAST_CHAT_INTERVAL = 1.0  # Minimum seconds between two messages to the same chat
+BROADCAST_CONCURRENCY = 10  # Messages in flight at once
+BROADCAST_BATCH_SIZE = 200  # Outbox rows taken per round
+BROADCAST_MAX_ATTEMPTS = 5
+
+# Function to add one message for many chats to the outbox, using an open cursor
+def queue_messages(c, chat_ids, text, reply_markup=None):
+    markup = reply_markup.to_json() if reply_markup else None
+    c.executemany("INSERT INTO outbox (chat_id, text, reply_markup) VALUES (?, ?, ?)",
+                  [(chat_id, text, markup) for chat_id in chat_ids])
+
+# Token bucket limiting how many operations may start per second
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Delivers queued messages from the persistent outbox table.
+# Sends run concurrently under a global rate limit; chats that were messaged too recently are deferred,
+# RetryAfter pauses all sending, and chats that blocked the bot are marked so they are skipped later.
+class Broadcaster:
+    def __init__(self):
+        self._limiter = RateLimiter(BROADCAST_RATE)
+        self._semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        self._last_sent = {}
+        self._paused_until = 0.0
+        self._task = None
+
+    # Function to queue one message for many chats
+    async def enqueue(self, chat_ids, text, reply_markup=None, database=None):
+        if chat_ids:
+            await (database or db).group_commit(queue_messages, chat_ids, text, reply_markup)
+        self.wake()
+
+    # Function to start delivering right away instead of at the next poll
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, application):
+        self._task = application.create_task(self._run(application.bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot):
+        while True:
+            rows = await db.fetchall("SELECT id, chat_id, text, reply_markup, attempts FROM outbox WHERE not_before <= ? ORDER BY id LIMIT ?",
+                                     (time.time(), BROADCAST_BATCH_SIZE))
+            if not rows:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Forget chats whose interval has passed, so the map only holds recently messaged chats
+            cutoff = time.monotonic() - BROADCAST_CHAT_INTERVAL
+            self._last_sent = {chat_id: sent for chat_id, sent in self._last_sent.items() if sent > cutoff}
+            try:
+                results = await asyncio.gather(*[self._deliver(bot, *row) for row in rows])
+                await db.local_transaction(self._apply_results, results)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Broadcast round failed")
+                await asyncio.sleep(1.0)
+
+    # Returns (outbox_id, outcome, chat_id, not_before) for one outbox row
+    async def _deliver(self, bot, outbox_id, chat_id, text, markup, attempts):
+        # Keep the per-chat interval by deferring instead of waiting
+        earliest = self._last_sent.get(chat_id, 0.0) + BROADCAST_CHAT_INTERVAL
+        if earliest > time.monotonic():
+            return outbox_id, 'retry', chat_id, time.time() + earliest - time.monotonic()
+        self._last_sent[chat_id] = time.monotonic()
+
+        async with self._semaphore:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._limiter.acquire()
+            try:
+                reply_markup = InlineKeyboardMarkup.de_json(json.loads(markup), bot) if markup else None
+                await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+                return outbox_id, 'sent', chat_id, None
+            except telegram.error.RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                return outbox_id, 'retry', chat_id, time.time() + retry_after
+            except telegram.error.Forbidden:
+                # User has blocked the bot
+                return outbox_id, 'blocked', chat_id, None
+            except telegram.error.BadRequest as e:
+                if "Chat not found" in str(e):
+                    # Chat not found, possibly the user removed or blocked the bot
+                    return outbox_id, 'blocked', chat_id, None
+                logger.warning("Dropping broadcast to %s: %s", chat_id, e)
+                return outbox_id, 'failed', chat_id, None
+            except telegram.error.TelegramError as e:
+                if attempts + 1 >= BROADCAST_MAX_ATTEMPTS:
+                    logger.warning("Giving up broadcast to %s: %s", chat_id, e)
+                    return outbox_id, 'failed', chat_id, None
+                return outbox_id, 'error', chat_id, time.time() + 2 ** attempts
+
+    # Function to write the outcome of one delivery round, using an open cursor
+    @staticmethod
+    def _apply_results(c, results):
+        done = [(outbox_id,) for outbox_id, outcome, _, _ in results if outcome in ('sent', 'blocked', 'failed')]
+        c.executemany("DELETE FROM outbox WHERE id = ?", done)
+        c.executemany("UPDATE outbox SET not_before = ? WHERE id = ?",
+                      [(not_before, outbox_id) for outbox_id, outcome, _, not_before in results if outcome == 'retry'])
+        c.executemany("UPDATE outbox SET not_before = ?, attempts = attempts + 1 WHERE id = ?",
+                      [(not_before, outbox_id) for outbox_id, outcome, _, not_before in results if outcome == 'error'])
+        blocked = [(chat_id,) for _, outcome, chat_id, _ in results if outcome == 'blocked']
+        c.executemany("UPDATE users SET blocked = 1 WHERE id = ?", blocked)
+        # Drop anything else still queued for chats that can no longer be reached
+        c.executemany("DELETE FROM outbox WHERE chat_id = ?", blocked)
+
+broadcaster = Broadcaster()
+
+
+
+TEAM_LEVELS = 3
+TEAM_MEMBERS_SHOWN = 20
+
+# Function to handle the /team command displaying the players the user referred, directly and through them
+async def team(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
 
-# # Function to handle the /team command displaying the user's team members
-# async def team(update: Update, context: CallbackContext) -> None:
-#     user_id = update.effective_user.id
+    # Get the user's username
+    profile = await user_profile(user_id)
+    if profile is None:
+        await update.message.reply_text("Use /start to join the game first.")
+        return
+    username = profile.username
 
-#     conn = sqlite3.connect('game.db')
-#     c = conn.cursor()
+    # Get the users who joined using the current user's invite link
+    team_members = await db.fetchall("""SELECT u.username FROM referrals r JOIN directory u ON u.user_id = r.invitee_id
+                                        WHERE r.inviter_id = ? ORDER BY r.created_at LIMIT ?""", (user_id, TEAM_MEMBERS_SHOWN))
+    levels = await db.fetchall("""SELECT depth, COUNT(*) FROM referral_closure
+                                  WHERE ancestor_id = ? AND depth <= ? GROUP BY depth ORDER BY depth""", (user_id, TEAM_LEVELS))
 
-#     # Get the user's username
-#     c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-#     username = c.fetchone()[0]
+    team_text = f"Your team (including yourself):\n1. {username}\n"
+    for i, member in enumerate(team_members, start=2):
+        team_text += f"{i}. {member[0]}\n"
 
-#     # Get the users who joined using the current user's invite link
-#     c.execute("SELECT username FROM users WHERE id IN (SELECT id FROM users WHERE invite_link LIKE ?)", (f"%{user_id}%",))
-#     team_members = c.fetchall()
+    if not team_members:
+        team_text += "\nNo team members have joined using your invite link yet."
+    else:
+        team_text += "\nPlayers by referral level:\n"
+        for depth, count in levels:
+            team_text += f"Level {depth}: {count}\n"
 
-#     team_text = f"Your team (including yourself):\n1. {username}\n"
-#     for i, member in enumerate(team_members, start=2):
-#         team_text += f"{i}. {member[0]}\n"
+    await update.message.reply_text(team_text)
 
-#     if not team_members:
-#         team_text += "\nNo team members have joined using your invite link yet."
 
-#     conn.close()
 
-#     await update.message.reply_text(team_text)
+# Function to create a company for the user, using an open cursor. Returns an error message or None.
+def execute_create_company(c, user_id, company_name, company_cost):
+    # Check if the user already owns a company
+    c.execute("SELECT id FROM companies WHERE owner_id = ?", (user_id,))
+    if c.fetchone():
+        return "You already own a company."
 
+    # Deduct funds from the user's balance to start the company, only if the balance covers it
+    c.execute("UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?", (company_cost, user_id, company_cost))
+    if c.rowcount == 0:
+        return "You don't have enough funds to create a company."
 
+    post_entry(c, 'company_fee', [('user', user_id, LEDGER_CASH, -company_cost), ('companies', None, LEDGER_CASH, company_cost)])
+    c.execute("INSERT INTO companies (name, owner_id) VALUES (?, ?) RETURNING id", (company_name, user_id))
+    c.execute("INSERT INTO company_members (company_id, user_id, role, status) VALUES (?, ?, 'owner', 'accepted')",
+              (c.fetchone()[0], user_id))
+    refresh_wealth(c, user_id)
+    return None
 
 async def create_company(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
 
     # Get the company name from the user input
     company_name = ' '.join(context.args)
@@ -588,26 +2659,12 @@ async def create_company(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text("Please provide a name for your company using /create_company <CompanyName>.")
         return
 
-    # Check if the user already owns a company
-    c.execute("SELECT * FROM companies WHERE owner_id = ?", (user_id,))
-    if c.fetchone():
-        await update.message.reply_text("You already own a company.")
-        return
-
-    # Deduct funds from the user's balance to start the company (e.g., 1000 units)
-    c.execute("SELECT balance FROM users WHERE id = ?", (user_id,))
-    balance = c.fetchone()[0]
     company_cost = 100.0
-
-    if balance < company_cost:
-        await update.message.reply_text("You don't have enough funds to create a company.")
+    error = await db.transaction(execute_create_company, user_id, company_name, company_cost)
+    if error:
+        await update.message.reply_text(error)
         return
-
-    c.execute("UPDATE users SET balance = balance - ? WHERE id = ?", (company_cost, user_id))
-    c.execute("INSERT INTO companies (name, owner_id) VALUES (?, ?)", (company_name, user_id))
-
-    conn.commit()
-    conn.close()
+    user_cache.invalidate(user_id)
 
     await update.message.reply_text(f"Congratulations! You have successfully created the company '{company_name}'.")
 
@@ -615,28 +2672,25 @@ async def create_company(update: Update, context: CallbackContext) -> None:
 
 async def show_company(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
 
     # Check if the user owns a company
-    c.execute("SELECT * FROM companies WHERE owner_id = ?", (user_id,))
-    company = c.fetchone()
+    company = await db.fetchone("SELECT id, name, value, profit_margin, team FROM companies WHERE owner_id = ?", (user_id,))
 
     if not company:
         await update.message.reply_text("You do not own a company.")
         return
 
-    company_id, name, owner_id, value, profit_margin, team = company
+    company_id, name, value, profit_margin, team = company
     company_info = (f"Company Name: {name}\n"
                     f"Value: {value:.2f} units\n"
+                    f"Rank: {company_ranking.rank(company_id)} of {len(company_ranking)}\n"
                     f"Profit Margin: {profit_margin:.2%}\n"
                     f"Team Size: {team}\n\n"
                     "Company Members:\n")
 
-    # Get members of the company
-    c.execute("SELECT u.username, m.role, m.status FROM company_members m JOIN users u ON m.user_id = u.id WHERE m.company_id = ?",
-              (company_id,))
-    members = c.fetchall()
+    # Get members of the company, without the owner's own row
+    members = await db.fetchall("""SELECT u.username, m.role, m.status FROM company_members m JOIN directory u ON m.user_id = u.user_id
+                                   WHERE m.company_id = ? AND m.user_id != ?""", (company_id, user_id))
 
     if members:
         for member in members:
@@ -645,27 +2699,58 @@ async def show_company(update: Update, context: CallbackContext) -> None:
     else:
         company_info += "No members in the company.\n"
 
-    keyboard = [[InlineKeyboardButton("Back to menu", callback_data='menu')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(company_info, reply_markup=BACK_TO_MENU_KEYBOARD)
 
-    await update.message.reply_text(company_info, reply_markup=reply_markup)
-    conn.close()
 
 
 
+COMPANY_RANKING_SIZE = 10
 
-async def invite_to_company(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
+# Function to display the companies with the highest value, served from the precomputed ranking
+async def show_company_ranking(update: Update, context: CallbackContext) -> None:
+    entries = company_ranking.top(COMPANY_RANKING_SIZE)
+    company_ids = [company_id for company_id, _ in entries]
+    names = dict(await db.fetchall(f"SELECT id, name FROM companies WHERE id IN ({','.join('?' * len(company_ids))})", company_ids))
+
+    ranking_text = "Company ranking:\n"
+    for i, (company_id, value) in enumerate(entries, start=1):
+        ranking_text += f"{i}. {names.get(company_id)}: {value:.2f} units\n"
+    if not entries:
+        ranking_text += "No companies yet.\n"
+
+    own = await db.fetchone("SELECT id FROM companies WHERE owner_id = ?", (update.effective_user.id,))
+    if own and company_ranking.rank(own[0]):
+        ranking_text += f"\nYour company: rank {company_ranking.rank(own[0])} of {len(company_ranking)} ({company_ranking.wealth(own[0]):.2f} units)"
+
+    await show(update, ranking_text, BACK_TO_MENU_KEYBOARD)
 
+# Function to record a company invitation, using an open cursor.
+# Returns an error message, or None and the invited user's ID.
+def execute_invite(c, user_id, target_username, role):
     # Check if the user owns a company
     c.execute("SELECT id FROM companies WHERE owner_id = ?", (user_id,))
     company = c.fetchone()
 
     if not company:
-        await update.message.reply_text("You do not own a company.")
-        return
+        return "You do not own a company.", None
+
+    c.execute("SELECT user_id FROM directory WHERE username = ?", (target_username,))
+    target_user = c.fetchone()
+
+    if not target_user:
+        return "The user you are trying to invite does not exist.", None
+
+    if target_user[0] == user_id:
+        return "You already run this company.", None
+
+    # Add invitation to the database; re-inviting a member takes them out of the company until they accept
+    c.execute("INSERT OR REPLACE INTO company_members (company_id, user_id, role, status) VALUES (?, ?, ?, ?)",
+              (company[0], target_user[0], role, 'pending'))
+    update_company_values(c, company[0])
+    return None, target_user[0]
+
+async def invite_to_company(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
 
     if len(context.args) < 2:
         await update.message.reply_text("Usage: /invite <username> <role>")
@@ -674,21 +2759,11 @@ async def invite_to_company(update: Update, context: CallbackContext) -> None:
     target_username = context.args[0]
     role = ' '.join(context.args[1:])
 
-    c.execute("SELECT id FROM users WHERE username = ?", (target_username,))
-    target_user = c.fetchone()
-
-    if not target_user:
-        await update.message.reply_text("The user you are trying to invite does not exist.")
+    error, target_user_id = await db.transaction(execute_invite, user_id, target_username, role)
+    if error:
+        await update.message.reply_text(error)
         return
 
-    target_user_id = target_user[0]
-
-    # Add invitation to the database
-    c.execute("INSERT OR REPLACE INTO company_members (company_id, user_id, role, status) VALUES (?, ?, ?, ?)",
-              (company[0], target_user_id, role, 'pending'))
-    conn.commit()
-    conn.close()
-
     # Notify the invited user
     await context.bot.send_message(chat_id=target_user_id,
                                    text=f"You have been invited to join the company by {update.effective_user.username} as {role}. Use /accept to join the company or /decline to reject the invitation.")
@@ -696,121 +2771,701 @@ async def invite_to_company(update: Update, context: CallbackContext) -> None:
 
 
 
-async def accept_invitation(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
-
+# Function to accept the user's pending invitation, using an open cursor.
+# Returns (company_name, role), or None if there is no pending invitation.
+def execute_accept(c, user_id):
     # Check for pending invitations
     c.execute("SELECT company_id, role FROM company_members WHERE user_id = ? AND status = 'pending'", (user_id,))
     invitation = c.fetchone()
 
     if not invitation:
-        await update.message.reply_text("You have no pending invitations.")
-        return
+        return None
 
     company_id, role = invitation
 
-    # Accept the invitation
+    # Accept the invitation, bringing the member's holdings into the company's value
     c.execute("UPDATE company_members SET status = 'accepted' WHERE company_id = ? AND user_id = ?",
               (company_id, user_id))
-    conn.commit()
+    c.execute("SELECT wealth - balance FROM users WHERE id = ?", (user_id,))
+    revalue_companies(c, [(user_id, c.fetchone()[0])])
 
     # Get company name
     c.execute("SELECT name FROM companies WHERE id = ?", (company_id,))
-    company_name = c.fetchone()[0]
+    return c.fetchone()[0], role
 
-    conn.close()
+async def accept_invitation(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    accepted = await db.transaction(execute_accept, user_id)
 
-    await update.message.reply_text(f"You have joined the company '{company_name}' as {role}.")
+    if not accepted:
+        await update.message.reply_text("You have no pending invitations.")
+        return
 
-async def decline_invitation(update: Update, context: CallbackContext) -> None:
-    user_id = update.effective_user.id
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
+    company_name, role = accepted
+    await update.message.reply_text(f"You have joined the company '{company_name}' as {role}.")
 
+# Function to decline the user's pending invitation, using an open cursor. Returns False if there is none.
+def execute_decline(c, user_id):
     # Check for pending invitations
     c.execute("SELECT company_id FROM company_members WHERE user_id = ? AND status = 'pending'", (user_id,))
     invitation = c.fetchone()
 
     if not invitation:
-        await update.message.reply_text("You have no pending invitations.")
-        return
-
-    company_id = invitation[0]
+        return False
 
     # Decline the invitation
-    c.execute("DELETE FROM company_members WHERE company_id = ? AND user_id = ?", (company_id, user_id))
-    conn.commit()
-    conn.close()
+    c.execute("DELETE FROM company_members WHERE company_id = ? AND user_id = ?", (invitation[0], user_id))
+    return True
+
+async def decline_invitation(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+
+    if not await db.transaction(execute_decline, user_id):
+        await update.message.reply_text("You have no pending invitations.")
+        return
 
     await update.message.reply_text("You have declined the invitation.")
 
 
 
 
+# Function to change the user's username, using an open cursor. Returns False if the name is taken.
+def execute_rename(c, user_id, new_username):
+    # Zaktualizuj username w katalogu i w tabeli users; unikalne indeksy odrzucają zajęte nazwy.
+    # Katalog idzie pierwszy, a savepoint cofa oba zapisy, gdy któryś z nich się nie powiedzie.
+    c.execute("SAVEPOINT rename")
+    try:
+        update_directory(c, user_id, new_username)
+        c.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, user_id))
+    except sqlite3.IntegrityError:
+        c.execute("ROLLBACK TO rename")
+        return False
+    finally:
+        c.execute("RELEASE rename")
+    return True
+
 async def username(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
-    conn = sqlite3.connect('game.db')
-    c = conn.cursor()
 
     # Sprawdź, czy użytkownik chce zmienić swój username
     if context.args:
         new_username = context.args[0]
 
-        # Sprawdź, czy username jest już używany
-        c.execute("SELECT id FROM users WHERE username = ?", (new_username,))
-        if c.fetchone():
+        if not await db.transaction(execute_rename, user_id, new_username):
             await update.message.reply_text(f"The username '{new_username}' is already taken. Please choose a different one.")
         else:
-            # Zaktualizuj username w tabeli users
-            c.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, user_id))
-            conn.commit()
+            user_cache.update(user_id, username=new_username)
             await update.message.reply_text(f"Your username has been changed to '{new_username}'.")
     else:
         # Wyświetl aktualny username
-        c.execute("SELECT username FROM users WHERE id = ?", (user_id,))
-        username = c.fetchone()[0]
-        await update.message.reply_text(f"Your current username is '{username}'.")
+        profile = await user_profile(user_id)
+        if profile is None:
+            await update.message.reply_text("Use /start to join the game first.")
+            return
+        await update.message.reply_text(f"Your current username is '{profile.username}'.")
 
-    conn.close()
 
 
+# Function to load the in-memory state (market snapshot, leaderboard) from the database
+async def load_state() -> None:
+    await db.read(market_cache.refresh)
+    await load_leaderboard()
 
-# Main bot function
-def main() -> None:
-    # Initialize database
-    init_db()
+# Function to pick up market changes committed by other workers, using an open cursor on this worker's shard.
+# Returns the products whose price moved since the holders on this shard were last repriced; none
+# are known after a start, so the first sync reprices every holder once.
+def sync_market(c):
+    return [product[0] for product in market_cache.refresh(c) if repriced_prices.get(product[0]) != product[2]]
 
+# Function to keep this worker's view of the shared state current in multi-worker mode
+async def sync_shared_state():
+    last_leaderboard_sync = time.monotonic()
+    while True:
+        await asyncio.sleep(MARKET_SYNC_INTERVAL)
+        try:
+            # Read-only unless prices moved, so an idle sync takes no write lock
+            changed = await db.read(sync_market)
+            if changed:
+                await db.transaction(reprice_holders, *changed)
+            if time.monotonic() - last_leaderboard_sync >= LEADERBOARD_SYNC_INTERVAL:
+                await load_leaderboard()
+                last_leaderboard_sync = time.monotonic()
+        except Exception:
+            logger.exception("Shared state sync failed")
+
+# Durable job scheduler. Jobs are rows of the jobs table, ordered in memory by a heap of due times.
+# Recurring jobs are registered in code and keep their next run in the table across restarts;
+# one-shot jobs are scheduled at runtime with a JSON payload. At most one run per job type is in
+# progress at a time, and runs missed while the bot was down are either caught up once or skipped.
+class Scheduler:
+    def __init__(self):
+        self._types = {}  # job_type -> {'fn', 'interval', 'catch_up'}
+        self._jobs = {}  # name -> (job_type, run_at, payload)
+        self._heap = []  # (run_at, name); entries whose run_at no longer matches the job are stale
+        self._running = {}  # job_type -> task
+        self._blocked = set()  # Due jobs waiting for a run of the same type to finish
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    # Registers a recurring job; interval is in seconds, or a function returning the next delay.
+    # fn() is awaited on every run.
+    def recurring(self, job_type, fn, interval, catch_up=False):
+        self._types[job_type] = {'fn': fn, 'interval': interval, 'catch_up': catch_up}
+
+    # Registers the function running one-shot jobs of a type; fn(payload) is awaited once per job
+    def one_shot(self, job_type, fn, catch_up=True):
+        self._types[job_type] = {'fn': fn, 'interval': None, 'catch_up': catch_up}
+
+    @staticmethod
+    def _delay(spec):
+        interval = spec['interval']
+        return interval() if callable(interval) else interval
+
+    # Function to schedule a one-shot job at the given UNIX time. Returns the job name.
+    async def schedule(self, job_type, run_at, payload=None):
+        name = f"{job_type}:{uuid.uuid4().hex[:12]}"
+        await db.execute_local("INSERT INTO jobs (name, job_type, run_at, payload) VALUES (?, ?, ?, ?)",
+                               (name, job_type, run_at, json.dumps(payload)))
+        self._set(name, job_type, run_at, payload)
+        return name
+
+    def _set(self, name, job_type, run_at, payload=None):
+        self._jobs[name] = (job_type, run_at, payload)
+        heapq.heappush(self._heap, (run_at, name))
+        self._wakeup.set()
+
+    # Loads the jobs table, adds newly registered recurring jobs and applies the missed-run policy
+    def _load(self, c, now):
+        c.execute("SELECT name, job_type, run_at, payload FROM jobs")
+        rows = {name: (job_type, run_at, payload) for name, job_type, run_at, payload in c.fetchall()}
+        jobs = {}
+        for job_type, spec in self._types.items():
+            if spec['interval'] is not None and job_type not in rows:
+                rows[job_type] = (job_type, now + self._delay(spec), 'null')
+                c.execute("INSERT INTO jobs (name, job_type, run_at, payload) VALUES (?, ?, ?, 'null')",
+                          (job_type, job_type, rows[job_type][1]))
+        for name, (job_type, run_at, payload) in rows.items():
+            spec = self._types.get(job_type)
+            if spec is None:
+                continue  # Left for a version of the bot that knows this job type
+            if run_at < now and not spec['catch_up']:
+                if spec['interval'] is None:
+                    c.execute("DELETE FROM jobs WHERE name = ?", (name,))
+                    continue
+                run_at = now + self._delay(spec)
+                c.execute("UPDATE jobs SET run_at = ? WHERE name = ?", (run_at, name))
+            jobs[name] = (job_type, run_at, json.loads(payload))
+        return jobs
+
+    async def start(self, application):
+        for name, (job_type, run_at, payload) in (await db.local_transaction(self._load, time.time())).items():
+            self._set(name, job_type, run_at, payload)
+        self._task = application.create_task(self._run())
+
+    async def stop(self):
+        tasks = [task for task in [self._task, *self._running.values()] if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._running.clear()
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                run_at, name = heapq.heappop(self._heap)
+                job = self._jobs.get(name)
+                if job is None or job[1] != run_at:
+                    continue
+                if job[0] in self._running:
+                    self._blocked.add(name)
+                    continue
+                self._running[job[0]] = asyncio.create_task(self._execute(name, *job))
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, name, job_type, run_at, payload):
+        spec = self._types[job_type]
+        started = time.time()
+        status = 'ok'
+        try:
+            if spec['interval'] is None:
+                await spec['fn'](payload)
+            else:
+                await spec['fn']()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            status = 'failed'
+            logger.exception("Job %s failed", name)
+        finally:
+            metrics.observe('bot_job_seconds', time.time() - started, (('job', job_type),))
+            metrics.inc('bot_job_runs_total', (('job', job_type), ('status', status)))
+
+        try:
+            if spec['interval'] is None:
+                del self._jobs[name]
+                await db.execute_local("DELETE FROM jobs WHERE name = ?", (name,))
+            else:
+                # Fixed intervals keep their cadence, skipping slots that already passed
+                delay = self._delay(spec)
+                next_run = run_at + delay if not callable(spec['interval']) else time.time() + delay
+                if next_run <= time.time():
+                    next_run = time.time() + delay
+                self._set(name, job_type, next_run)
+                await db.execute_local("UPDATE jobs SET run_at = ?, last_run = ?, last_status = ? WHERE name = ?",
+                                       (next_run, started, status, name))
+        finally:
+            del self._running[job_type]
+            # Jobs of this type that came due in the meantime run now
+            for blocked in [blocked for blocked in self._blocked if self._jobs.get(blocked, (None,))[0] == job_type]:
+                self._blocked.discard(blocked)
+                heapq.heappush(self._heap, (self._jobs[blocked][1], blocked))
+            self._wakeup.set()
+
+scheduler = Scheduler()
+
+# Function to register this worker's jobs; the shared market is driven by the first worker only
+def register_jobs():
+    if WORKER_INDEX == 0:
+        scheduler.recurring('economic_event', generate_economic_event, lambda: random.randint(10, 60))  # Random delay between 1 minute and 3 hours
+        if MARKET_MODEL:
+            scheduler.recurring('market_simulation', functools.partial(run_market_simulation, create_market_simulator()), SIMULATION_TICK)
+        scheduler.recurring('price_history_maintenance', price_history_maintenance, 3600, catch_up=True)
+    scheduler.one_shot('market_event', scheduled_market_event)
+    scheduler.recurring('digests', send_digests, DIGEST_CHECK_INTERVAL, catch_up=True)
+    scheduler.recurring('transaction_archival', archive_transactions, 86400, catch_up=True)
+    scheduler.recurring('wealth_snapshots', wealth_snapshots, WEALTH_SNAPSHOT_INTERVAL, catch_up=True)
+    if BACKUP_INTERVAL:
+        scheduler.recurring('backups', scheduled_backups, BACKUP_INTERVAL, catch_up=True)
+
+# Function to handle the admin /schedule_event <product> <boom|crash> <minutes> command
+async def schedule_event(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        product_name, event_type, minutes = context.args
+        minutes = float(minutes)
+    except ValueError:
+        await update.message.reply_text("Usage: /schedule_event <product> <boom|crash> <minutes>")
+        return
+    product = market_cache.snapshot.find(product_name)
+    if not product or event_type not in ('boom', 'crash'):
+        await update.message.reply_text("Usage: /schedule_event <product> <boom|crash> <minutes>")
+        return
+
+    await scheduler.schedule('market_event', time.time() + minutes * 60, {'product_id': product[0], 'event_type': event_type})
+    await update.message.reply_text(f"A {event_type} of {product[1]} is scheduled in {minutes:g} minutes.")
+
+# Runs once the application is initialized, before polling starts
+async def post_init(application: Application) -> None:
+    await load_state()
+
+    # Start delivering this shard's queued broadcasts
+    broadcaster.start(application)
+    if WORKER_INDEX == 0 and MARKET_MODEL and MARKET_INSTRUMENTS:
+        await db.transaction(seed_instruments, MARKET_INSTRUMENTS, MARKET_SEED)
+        await db.read(market_cache.refresh)
+    # Market events, digests and maintenance run as scheduled jobs
+    register_jobs()
+    await scheduler.start(application)
+    if SHARDED:
+        application.create_task(sync_shared_state())
+    application.create_task(monitor_event_loop_lag())
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await serve_metrics(METRICS_PORT + WORKER_INDEX)
+    # application.create_task(generate_hossa_bessa_event(application))
+
+# Runs after polling stops
+async def post_shutdown(application: Application) -> None:
+    await scheduler.stop()
+    await broadcaster.stop()
+    for manager in backup_managers():
+        manager.close()
+    close_databases()
+
+# Per-user limits applied to every update before any handler runs
+USER_RATE = 2.0  # Updates per second a user can sustain
+USER_BURST = 8  # Updates a user can send at once after being idle
+USER_BUCKETS_MAX = 100000  # Buckets kept before fully refilled ones are dropped
+CONCURRENT_UPDATES = 64  # Updates processed at once; a single user is bounded by the limits above
+THROTTLED_TEXT = "Slow down a little, try again in a moment."
+
+# Token bucket per user. Only used on the event loop, so it needs no lock.
+class UserRateLimiter:
+    def __init__(self, rate=USER_RATE, burst=USER_BURST, max_users=USER_BUCKETS_MAX):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = {}  # user_id -> (tokens, updated)
+        self._evict_at = max_users
+
+    # Takes a token and returns True when the user may proceed
+    def allow(self, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        tokens, updated = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > self._evict_at:
+            self._evict(now)
+        return allowed
+
+    # Drops the buckets that have refilled completely, they behave like a missing bucket
+    def _evict(self, now):
+        refill = self.burst / self.rate
+        self._buckets = {user_id: bucket for user_id, bucket in self._buckets.items() if now - bucket[1] < refill}
+        self._evict_at = max(self.max_users, 2 * len(self._buckets))
+
+user_limiter = UserRateLimiter()
+
+# Function to answer a callback query, ignoring queries that are too old to answer
+async def answer_quietly(query, text=None):
+    try:
+        await query.answer(text)
+    except telegram.error.TelegramError:
+        pass
+
+# Application running every update through the per-user limits first. Throttled updates are
+# dropped (callback queries get a short answer so the button stops spinning), and a callback
+# query is coalesced into an identical one from the same user that is still being handled.
+class GameApplication(Application):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._callbacks_in_flight = set()
+
+    async def process_update(self, update):
+        if not isinstance(update, Update) or update.effective_user is None:
+            return await super().process_update(update)
+        user_id = update.effective_user.id
+        query = update.callback_query
+
+        key = (user_id, query.data) if query else None
+        if key in self._callbacks_in_flight:
+            metrics.inc('bot_coalesced_callbacks_total')
+            await answer_quietly(query)
+            return
+        if not user_limiter.allow(user_id):
+            metrics.inc('bot_throttled_updates_total', (('kind', 'callback' if query else 'message'),))
+            if query:
+                await answer_quietly(query, THROTTLED_TEXT)
+            return
+
+        if key is None:
+            return await super().process_update(update)
+        self._callbacks_in_flight.add(key)
+        try:
+            return await super().process_update(update)
+        finally:
+            self._callbacks_in_flight.discard(key)
+
+# Command handlers, registered with instrumentation in build_application()
+COMMANDS = [
+    ("start", start),
+    ("referral", referral),
+    ("ranking", ranking),
+    ("buy", order_command),
+    ("sell", order_command),
+    ("portfolio", portfolio),
+    ("how_to_play", how_to_play),
+    ("history", history),
+    ("history_trades", history_trades),
+    ("chart", chart),
+    ("team", team),
+    ("create_company", create_company),
+    ("show_company", show_company),
+    ("company_ranking", show_company_ranking),
+    ("notifications", notifications),
+    ("username", username),
+    ("invite", invite_to_company),
+    ("accept", accept_invitation),
+    ("decline", decline_invitation),
+    ("profile", profile),
+    ("backup", backup),
+    ("schedule_event", schedule_event),
+]
+
+# Function to build the application with all handlers registered
+def build_application(**hooks) -> Application:
     # Bot token
-    application = Application.builder().token("7244283258:AAGiCySykhK9alu-YOr8FtdA8K7Q177Atbw").build()
+    builder = (Application.builder().token("7244283258:AAGiCySykhK9alu-YOr8FtdA8K7Q177Atbw")
+               .application_class(GameApplication).concurrent_updates(CONCURRENT_UPDATES).request(InstrumentedRequest()))
+    if 'post_init' in hooks:
+        builder = builder.post_init(hooks['post_init'])
+    if 'post_shutdown' in hooks:
+        builder = builder.post_shutdown(hooks['post_shutdown'])
+    application = builder.build()
 
     # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("referral", referral))
-    application.add_handler(CommandHandler("ranking", ranking))
-    application.add_handler(CallbackQueryHandler(button))
-    application.add_handler(CommandHandler("buy", buy))
-    application.add_handler(CommandHandler("portfolio", portfolio))
-    application.add_handler(CommandHandler("how_to_play", how_to_play))
-    # application.add_handler(CommandHandler("team", team))
-    application.add_handler(CommandHandler("create_company", create_company))
-    application.add_handler(CommandHandler("show_company", show_company))
-    application.add_handler(CommandHandler("username", username))
-    application.add_handler(CommandHandler("invite", invite_to_company))
-    application.add_handler(CommandHandler("accept", accept_invitation))
-    application.add_handler(CommandHandler("decline", decline_invitation))
-
+    for command, callback in COMMANDS:
+        application.add_handler(CommandHandler(command, instrumented(command, callback)))
+    application.add_handler(CallbackQueryHandler(instrumented('button', button, label=callback_label)))
+    return application
+
+
+# Webhook mode for serverless deployments (Vercel serves this module at /api/bot).
+# The application and the event loop are created on the first request and reused
+# by every warm invocation of the same instance.
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+_webhook_application = None
+_webhook_loop = None
+_webhook_watch = None  # Connection that only reads PRAGMA data_version
+_webhook_data_version = None
+_webhook_leaderboard_version = None
+_webhook_leaderboard_synced = 0.0
+
+# Function to return the initialized webhook application, creating it on first use
+async def get_webhook_application() -> Application:
+    global _webhook_application
+    if _webhook_application is None:
+        init_db()
+        application = build_application()
+        await application.initialize()
+        _webhook_application = application
+    await sync_webhook_state()
+    return _webhook_application
+
+# Function to pick up what was committed since the previous update. Serverless instances serve
+# requests side by side on one database, so each one follows the others' trades and signups:
+# the market snapshot and the profile cache on every change, the ranking at most every
+# LEADERBOARD_SYNC_INTERVAL as reloading it reads every user.
+async def sync_webhook_state():
+    global _webhook_watch, _webhook_data_version, _webhook_leaderboard_version, _webhook_leaderboard_synced
+    if _webhook_watch is None:
+        _webhook_watch = db.connect()
+    # data_version changes whenever a connection other than this one commits, including this instance's pool
+    data_version = _webhook_watch.execute("PRAGMA data_version").fetchone()[0]
+    if data_version != _webhook_data_version:
+        _webhook_data_version = data_version
+        await db.read(market_cache.refresh)
+        user_cache.clear()
+    if data_version != _webhook_leaderboard_version and time.monotonic() - _webhook_leaderboard_synced >= LEADERBOARD_SYNC_INTERVAL:
+        await load_leaderboard()
+        _webhook_leaderboard_version = data_version
+        _webhook_leaderboard_synced = time.monotonic()
+
+# Function to process one update received by the webhook
+async def handle_webhook_update(payload) -> None:
+    application = await get_webhook_application()
+    await application.process_update(Update.de_json(payload, application.bot))
+
+# Telegram webhook endpoint: checks the secret token, parses one update per POST request and hands it
+# to process_payload(); GET requests are health checks. Subclasses define process_payload(self, payload);
+# served as is, the endpoint takes no updates and answers 404.
+class WebhookHandler(BaseHTTPRequestHandler):
+    process_payload = None
+
+    def do_POST(self):
+        if self.process_payload is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if WEBHOOK_SECRET and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        self.process_payload(payload)
+        self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+# Serverless request handler: processes the update in this instance
+class handler(WebhookHandler):
+    def process_payload(self, payload):
+        global _webhook_loop
+        if _webhook_loop is None:
+            _webhook_loop = asyncio.new_event_loop()
+        try:
+            _webhook_loop.run_until_complete(handle_webhook_update(payload))
+        except Exception:
+            # Answer 200 anyway, otherwise Telegram keeps redelivering the same update
+            logger.exception("Failed to process webhook update")
+
+# Multi-worker mode: a dispatcher receives webhook updates and routes each one to the worker
+# process owning the sender's shard, so all updates of a user are handled by the same worker.
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+
+# Function to return the id of the user who sent an update, or None for updates without a sender
+def update_user_id(payload):
+    for value in payload.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id')
+    return None
+
+# Worker process: feeds the updates routed to it into its own application
+def run_worker(updates):
+    asyncio.run(serve_worker(updates))
+
+async def serve_worker(updates):
+    application = build_application()
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            payload = await loop.run_in_executor(None, updates.get)
+            if payload is None:
+                break
+            await application.update_queue.put(Update.de_json(payload, application.bot))
+    finally:
+        await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+# Dispatcher request handler: routes each POSTed update to its worker's queue
+class DispatchHandler(WebhookHandler):
+    worker_queues = []
+
+    def process_payload(self, payload):
+        user_id = update_user_id(payload)
+        shard = shard_of(user_id, len(self.worker_queues)) if user_id is not None else 0
+        self.worker_queues[shard].put(payload)
+
+# Function to start WORKER_COUNT worker processes and serve the webhook dispatcher
+def dispatch() -> None:
+    for database in all_databases():
+        init_db(database)
+    reconcile_stock()
+
+    context = multiprocessing.get_context('spawn')
+    for index in range(WORKER_COUNT):
+        updates = context.Queue()
+        # Workers read their shard from the environment when the module is imported
+        os.environ['WORKER_INDEX'] = str(index)
+        context.Process(target=run_worker, args=(updates,), name=f'worker-{index}', daemon=True).start()
+        DispatchHandler.worker_queues.append(updates)
+    os.environ['WORKER_INDEX'] = str(WORKER_INDEX)
+
+    server = ThreadingHTTPServer(('0.0.0.0', WEBHOOK_PORT), DispatchHandler)
+    try:
+        server.serve_forever()
+    finally:
+        for updates in DispatchHandler.worker_queues:
+            updates.put(None)
+
+# Function to bring market availability back in line with the holdings of all shards, using one connection per shard.
+# A trade writes the shard and the shared file in one transaction, but a commit over attached WAL files is not
+# atomic, so a crash can leave stock taken without the holding (or the reverse). Run only while nothing trades,
+# i.e. at startup. Products whose supply is not known yet get it from their current state.
+# Returns [(product_id, availability), ...] for the products that were repaired.
+def reconcile_stock(databases=None):
+    databases = databases or all_databases()
+    held = collections.Counter()
+    for database in databases:
+        conn = database.connect()
+        try:
+            held.update(dict(conn.execute("SELECT product_id, SUM(quantity) FROM holdings GROUP BY product_id")))
+        finally:
+            conn.close()
 
+    conn = databases[0].connect()
+    try:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT id, availability, supply FROM market")
+        products = c.fetchall()
+        c.executemany("UPDATE market SET supply = ? WHERE id = ?",
+                      [(availability + held[product_id], product_id) for product_id, availability, supply in products if supply is None])
+        repaired = [(product_id, supply - held[product_id]) for product_id, availability, supply in products
+                    if supply is not None and availability != supply - held[product_id]]
+        c.executemany("UPDATE market SET availability = ? WHERE id = ?", [(availability, product_id) for product_id, availability in repaired])
+        conn.commit()
+    finally:
+        conn.close()
+    for product_id, availability in repaired:
+        logger.warning("Market stock of product %s repaired to %s", product_id, availability)
+    return repaired
+
+# Function to run the bot: polling, or the dispatcher with its workers in multi-worker mode
+def run_bot(args) -> None:
+    if SHARDED:
+        dispatch()
+        return
 
+    # Initialize database
+    init_db()
+    reconcile_stock([db])
 
-    # Start generating random economic events
-    loop = asyncio.get_event_loop()
-    loop.create_task(generate_economic_event(application))
-    # loop.create_task(generate_hossa_bessa_event(application))
+    application = build_application(post_init=post_init, post_shutdown=post_shutdown)
 
     # Start the bot
     application.run_polling()
 
+# Function to snapshot every database file now: all shards and the shared file in multi-worker mode
+def run_backup(args) -> None:
+    paths = [shard_path(shard) for shard in range(WORKER_COUNT)] + ([SHARED_DB_PATH] if SHARDED else [])
+    for path in paths:
+        manager = BackupManager(path)
+        print(manager.snapshot(force=True))
+        manager.close()
+
+def run_restore(args) -> None:
+    restore_backup(args.snapshot, args.target)
+    print(f"Restored {args.target or db.path} from {args.snapshot}")
+
+# Function to replay every shard's ledger, then report drift from the live tables or, with --apply, overwrite them.
+# Run it with the bot stopped. Exits with status 1 when the ledger is unbalanced or the live state drifted.
+def run_ledger(args) -> None:
+    failed = False
+    for shard in range(WORKER_COUNT):
+        database = shard_database(shard)
+        init_db(database)
+        conn = database.connect()
+        try:
+            c = conn.cursor()
+            started = time.perf_counter()
+            balances, holdings, unbalanced, rows = replay_ledger(c)
+            print(f"{database.path}: replayed {rows} postings for {len(balances)} users in {time.perf_counter() - started:.2f}s")
+            for entry, asset, imbalance in unbalanced:
+                print(f"  unbalanced entry {entry}: asset {asset} sums to {imbalance:+.2f}")
+            if args.action == 'apply':
+                apply_replay(c, balances, holdings)
+                conn.commit()
+                print("  live balances and holdings rebuilt")
+                continue
+            drift = check_ledger(c, balances, holdings)
+            for user_id, asset, expected, live in drift[:args.limit]:
+                what = 'balance' if asset == LEDGER_CASH else f'product {asset}'
+                print(f"  user {user_id} {what}: ledger {expected}, live {live}")
+            if len(drift) > args.limit:
+                print(f"  ... and {len(drift) - args.limit} more")
+            print(f"  {len(drift)} drifted values, {len(unbalanced)} unbalanced entries")
+            failed = failed or bool(drift or unbalanced)
+        finally:
+            conn.close()
+    if failed:
+        sys.exit(1)
+
+# Main bot function
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Wolfs of Ton Street bot")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help="Run the bot (default)").set_defaults(func=run_bot)
+    commands.add_parser('backup', help="Take a snapshot of the database now").set_defaults(func=run_backup)
+    restore_parser = commands.add_parser('restore', help="Restore the database from a snapshot, with the bot stopped")
+    restore_parser.add_argument('snapshot')
+    restore_parser.add_argument('target', nargs='?', help="Database file to overwrite, defaults to GAME_DB")
+    restore_parser.set_defaults(func=run_restore)
+    ledger_parser = commands.add_parser('ledger', help="Replay the ledger and check or rebuild balances, with the bot stopped")
+    ledger_parser.add_argument('action', choices=['check', 'apply'],
+                               help="check: report drift from the live tables; apply: overwrite them with the replayed state")
+    ledger_parser.add_argument('--limit', type=int, default=50, help="Drifted values to print per shard")
+    ledger_parser.set_defaults(func=run_ledger)
+    args = parser.parse_args()
+    getattr(args, 'func', run_bot)(args)
+
 if __name__ == '__main__':
     main()
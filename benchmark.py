@@ -0,0 +1,298 @@
+# Offline load test and benchmark harness for the bot handlers.
+#
+# Seeds a throwaway database with synthetic users, portfolios and trades, then replays a concurrent
+# mixed workload against the real handlers using real telegram Update/CallbackQuery objects bound to
+# a local recording Bot, so nothing is sent to Telegram. Reports latency percentiles, throughput,
+# SQL statements and outbound API calls per handler.
+#
+# Usage: python benchmark.py --users 100000 --ops 20000 --concurrency 50
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telegram import Update
+
+
+# Records every Bot API call instead of sending it, optionally simulating network latency
+class RecordingBot:
+    defaults = None  # Read by telegram objects when they are deserialized with this bot
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_id = 0
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if method.startswith('send_') or method.startswith('edit_message'):
+                return self._message(kwargs.get('chat_id', 0), kwargs.get('text') or kwargs.get('caption'))
+            return True
+        return call
+
+    def _message(self, chat_id, text):
+        self._message_id += 1
+        return Update.de_json({'update_id': 0, 'message': _message_payload(chat_id, text or '', self._message_id)}, self).message
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+def _user_payload(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'Bench {user_id}', 'username': f'bench_{user_id}'}
+
+
+def _message_payload(user_id, text, message_id=1):
+    return {'message_id': message_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': user_id, 'type': 'private'}, 'from': _user_payload(user_id)}
+
+
+# Builds synthetic updates and contexts as PTB would deliver them
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_id = 0
+
+    def _next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def command(self, user_id, command, *args):
+        text = ' '.join((f'/{command}',) + tuple(str(arg) for arg in args))
+        payload = _message_payload(user_id, text)
+        payload['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command) + 1}]
+        update = Update.de_json({'update_id': self._next_id(), 'message': payload}, self.bot)
+        return update, self.context(*args)
+
+    def callback(self, user_id, data):
+        payload = {'id': str(self._next_id()), 'from': _user_payload(user_id), 'chat_instance': str(user_id),
+                   'data': data, 'message': _message_payload(user_id, '')}
+        update = Update.de_json({'update_id': self._update_id, 'callback_query': payload}, self.bot)
+        return update, self.context()
+
+    def context(self, *args):
+        return SimpleNamespace(args=[str(arg) for arg in args], bot=self.bot, application=SimpleNamespace(bot=self.bot))
+
+
+# Function to fill the database with synthetic users, holdings and trades
+def seed_database(bot_module, users, holdings_per_user, trades_per_user, seed):
+    rng = random.Random(seed)
+    conn = bot_module.db.connect()
+    c = conn.cursor()
+    product_ids = [product[0] for product in bot_module.market_cache.snapshot.products] or [1, 2, 3, 4, 5, 6]
+    start_ts = time.time() - 90 * 86400
+
+    batch = 10000
+    for first in range(1, users + 1, batch):
+        ids = range(first, min(first + batch, users + 1))
+        c.executemany("INSERT OR IGNORE INTO users (id, username, balance, invite_link, invite_code) VALUES (?, ?, ?, ?, ?)",
+                      [(user_id, f"bench_{user_id}", round(rng.uniform(0, 5000), 2),
+                        bot_module.generate_invite_link(f"b{user_id:07x}"), f"b{user_id:07x}") for user_id in ids])
+        c.executemany("INSERT OR IGNORE INTO holdings (user_id, product_id, quantity) VALUES (?, ?, ?)",
+                      [(user_id, product_id, rng.randint(1, 50)) for user_id in ids
+                       for product_id in rng.sample(product_ids, min(len(product_ids), rng.randint(0, holdings_per_user)))])
+        c.executemany("INSERT INTO transactions (user_id, type, product_id, amount, price, date) VALUES (?, ?, ?, ?, ?, ?)",
+                      [(user_id, rng.choice(('buy', 'sell')), rng.choice(product_ids), rng.randint(1, 10), round(rng.uniform(1, 2000), 2),
+                        datetime.fromtimestamp(start_ts + rng.uniform(0, 90 * 86400), timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+                       for user_id in ids for _ in range(rng.randint(0, 2 * trades_per_user))])
+    c.execute(f"UPDATE users SET wealth = {bot_module.WEALTH_SQL}")
+    conn.commit()
+    conn.close()
+
+
+# Function to compute a percentile of a sorted list
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class HandlerStats:
+    def __init__(self):
+        self.latencies = []
+        self.queries = 0
+        self.errors = 0
+
+
+# Replays a concurrent mixed workload and collects per-handler statistics
+class Driver:
+    def __init__(self, bot_module, users, concurrency, mix, seed, api_latency):
+        self.bot_module = bot_module
+        self.users = users
+        self.concurrency = concurrency
+        self.mix = mix
+        self.rng = random.Random(seed)
+        self.telegram = RecordingBot(api_latency)
+        self.factory = UpdateFactory(self.telegram)
+        self.stats = {}
+        self._next_new_user = users + 1
+
+    # Builds the coroutine for one operation of the given kind
+    def operation(self, kind):
+        bot = self.bot_module
+        user_id = self.rng.randint(1, self.users)
+        products = bot.market_cache.snapshot.products
+        product_id = self.rng.choice(products)[0]
+        if kind == 'start':
+            user_id = self._next_new_user
+            self._next_new_user += 1
+            return bot.start(*self.factory.command(user_id, 'start'))
+        if kind == 'buy':
+            return bot.button(*self.factory.callback(user_id, f'buy_{product_id}_{self.rng.choice((1, 10))}'))
+        if kind == 'sell':
+            return bot.button(*self.factory.callback(user_id, f'sell_{product_id}'))
+        if kind == 'portfolio':
+            return bot.button(*self.factory.callback(user_id, 'portfolio'))
+        if kind == 'menu':
+            return bot.button(*self.factory.callback(user_id, 'menu'))
+        if kind == 'market':
+            return bot.button(*self.factory.callback(user_id, 'show_market'))
+        if kind == 'ranking':
+            return bot.ranking(*self.factory.command(user_id, 'ranking'))
+        if kind == 'trades':
+            return bot.history_trades(*self.factory.command(user_id, 'history_trades'))
+        if kind == 'event':
+            return self.economic_event(product_id)
+        raise ValueError(f"Unknown operation: {kind}")
+
+    # One run of the economic_event job, on a product chosen by the benchmark
+    async def economic_event(self, product_id):
+        bot = self.bot_module
+        event_type = self.rng.choice(['boom', 'crash'])
+        product_name = await bot.db.transaction(bot.apply_price_event, product_id, event_type)
+        await bot.publish_event(f'Benchmark event for {product_name}', product_id)
+
+    async def _run_one(self, kind):
+        stats = self.stats.setdefault(kind, HandlerStats())
+        # The bot's own per-request SQL accounting counts the statements of this operation
+        request = self.bot_module.RequestStats()
+        self.bot_module.request_stats.set(request)
+        started = time.perf_counter()
+        try:
+            await self.operation(kind)
+        except Exception as e:
+            stats.errors += 1
+            if stats.errors == 1:
+                print(f"{kind} failed: {e!r}", file=sys.stderr)
+        stats.latencies.append(time.perf_counter() - started)
+        stats.queries += request.statements
+
+    async def run(self, ops):
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        plan = self.rng.choices(kinds, weights, k=ops)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def worker(kind):
+            async with semaphore:
+                await asyncio.create_task(self._run_one(kind))
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(kind) for kind in plan])
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        rows = []
+        for kind, stats in sorted(self.stats.items()):
+            latencies = sorted(stats.latencies)
+            rows.append({
+                'handler': kind,
+                'count': len(latencies),
+                'errors': stats.errors,
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'ops_per_s': len(latencies) / elapsed if elapsed else 0.0,
+                'queries_per_op': stats.queries / len(latencies) if latencies else 0.0,
+            })
+        return {
+            'elapsed_s': elapsed,
+            'total_ops': sum(row['count'] for row in rows),
+            'throughput_ops_per_s': sum(row['count'] for row in rows) / elapsed if elapsed else 0.0,
+            'api_calls': dict(self.telegram.calls),
+            'handlers': rows,
+        }
+
+
+def print_report(report):
+    print(f"{'handler':<10} {'count':>7} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9} {'sql/op':>7}")
+    for row in report['handlers']:
+        print(f"{row['handler']:<10} {row['count']:>7} {row['errors']:>5} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+              f"{row['p99_ms']:>9.2f} {row['ops_per_s']:>9.1f} {row['queries_per_op']:>7.1f}")
+    print(f"\n{report['total_ops']} operations in {report['elapsed_s']:.2f}s "
+          f"({report['throughput_ops_per_s']:.1f} ops/s)")
+    print("Bot API calls: " + ', '.join(f"{method}={count}" for method, count in sorted(report['api_calls'].items())))
+
+
+DEFAULT_MIX = {'start': 2, 'buy': 25, 'sell': 15, 'portfolio': 20, 'menu': 20, 'market': 10, 'ranking': 5, 'trades': 2, 'event': 1}
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+async def run_benchmark(args):
+    import bot
+
+    bot.init_db()
+    await bot.load_state()
+    if args.instruments:
+        await bot.db.transaction(bot.seed_instruments, args.instruments, args.seed)
+        await bot.db.transaction(bot.market_cache.refresh)
+
+    print(f"Seeding {args.users} users...", file=sys.stderr)
+    started = time.perf_counter()
+    seed_database(bot, args.users, args.holdings, args.trades, args.seed)
+    await bot.load_state()
+    print(f"Seeded in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    driver = Driver(bot, args.users, args.concurrency, args.mix, args.seed, args.api_latency / 1000)
+    elapsed = await driver.run(args.ops)
+    bot.db.close()
+    return driver.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the bot handlers")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--holdings', type=int, default=3, help="Maximum products held per user")
+    parser.add_argument('--trades', type=int, default=5, help="Average seeded trades per user")
+    parser.add_argument('--instruments', type=int, default=0, help="Generated instruments to add to the market")
+    parser.add_argument('--ops', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help="e.g. buy=5,sell=3,portfolio=2")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="Simulated Bot API latency in ms")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help="Database file (default: a fresh temporary file)")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    os.environ['GAME_DB'] = args.db or os.path.join(tempfile.mkdtemp(prefix='wolfs-bench-'), 'game.db')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api'))
+
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()